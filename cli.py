@@ -1,15 +1,16 @@
 #!/usr/bin/env python3
 
-import yaml
 import json
 from shutil import rmtree
 import urllib.request
 import logging
 import argparse
 import os
+from concurrent.futures import ThreadPoolExecutor
+from collections import Counter
 from utils.common import *
 from utils.database import Database
-from utils.config import Config
+from utils.config import Config, load_yaml
 
 class ServerCli():
     def __init__(self):
@@ -25,6 +26,9 @@ class ServerCli():
         parser.add_argument("-p", "--parse-configs", action="store_true")
         parser.add_argument("-w", "--create-worker", action="store_true")
         parser.add_argument("-a", "--create-all", action="store_true")
+        parser.add_argument("-m", "--mirror", help="read target lists from local mirror directory")
+        parser.add_argument("--distro", help="distribution of --create-all, all active distros if unset")
+        parser.add_argument("--version", help="version of --create-all, latest version if unset")
         self.args = vars(parser.parse_args())
         if self.args["download_versions"]:
             self.download_versions()
@@ -38,21 +42,35 @@ class ServerCli():
         if self.args["create_all"]:
             self.create_all_profiles()
 
+    # queue images of all profiles via the bulk build request api
     def create_all_profiles(self):
-        for profile in self.database.get_all_profiles():
-            target, subtarget, board = profile
-            image_params = {
-                "distro": "openwrt",
-                "version": "18.06.1",
-                "target": target,
-                "subtarget": subtarget,
-                "board": board
-                }
-            params = json.dumps(image_params).encode('utf8')
-            req = urllib.request.Request(self.config.get("server") +
-                    "/api/build-request", data=params,
-                    headers={'content-type': 'application/json'} )
-            urllib.request.urlopen(req)
+        images = []
+        distros = [self.args["distro"]] if self.args["distro"] else self.config.get("active_distros", [])
+        for distro in distros:
+            version = self.args["version"] or (self.config.get(distro) or {}).get("latest")
+            for target, subtarget, board in self.database.get_all_profiles(distro, version):
+                images.append({
+                    "distro": distro,
+                    "version": version,
+                    "target": target,
+                    "subtarget": subtarget,
+                    "board": board
+                    })
+
+        chunk_size = self.config.get("build_request_bulk_size", 10000)
+        chunks = [images[i:i + chunk_size] for i in range(0, len(images), chunk_size)]
+        statuses = Counter()
+        with ThreadPoolExecutor(self.config.get("bootstrap_threads", 8)) as executor:
+            for results in executor.map(self.post_build_requests, chunks):
+                statuses.update(result["status"] for result in results)
+        self.log.info("requested %d images: %s", len(images), dict(statuses))
+
+    def post_build_requests(self, images):
+        req = urllib.request.Request(self.config.get("server") +
+                "/api/build-request/bulk", data=json.dumps(images).encode('utf8'),
+                headers={'content-type': 'application/json'} )
+        with urllib.request.urlopen(req) as response:
+            return json.loads(response.read().decode('utf-8'))
 
     def create_worker_image(self):
         self.log.info("build worker image")
@@ -79,6 +97,7 @@ class ServerCli():
         self.log.info("response: %s", response)
 
     def download_versions(self):
+        versions = []
         for distro in self.config.get("active_distros", "openwrt"):
             # set distro alias like OpenWrt, fallback would be openwrt
             self.database.insert_distro({
@@ -96,7 +115,29 @@ class ServerCli():
                     "description": version_config.get("version_description", ""),
                     "snapshots": version_config.get("snapshots", False)
                     })
-                version_config = self.config.version(distro, version)
+                versions.append((distro, version))
+
+        # target lists are fetched in parallel, subtargets of a version are
+        # then inserted at once
+        with ThreadPoolExecutor(self.config.get("bootstrap_threads", 8)) as executor:
+            for (distro, version), version_targets in zip(versions,
+                    executor.map(lambda v: self.get_version_targets(*v), versions)):
+                if version_targets is None:
+                    continue
+                self.log.info("add %d %s/%s targets", len(version_targets), distro, version)
+                self.database.insert_subtargets(distro, version,
+                        [target.split("/") for target in sorted(version_targets)])
+
+    # returns set of "target/subtarget" of a version, read from the mirror
+    # directory <mirror>/<distro>/<version>/targets.json if set
+    def get_version_targets(self, distro, version):
+        version_config = self.config.version(distro, version)
+        mirror = self.args.get("mirror") or self.config.get("targets_mirror")
+        try:
+            if mirror:
+                with open(os.path.join(mirror, distro, version, "targets.json")) as targets_file:
+                    version_targets = set(json.load(targets_file))
+            else:
                 version_url = version_config.get("targets_url")
                 # use parent_version for ImageBuilder if exists
                 version_imagebuilder = version_config.get("parent_version", version)
@@ -104,20 +145,17 @@ class ServerCli():
                 version_targets = set(json.loads(urllib.request.urlopen(
                     "{}/{}/targets?json-targets".format(version_url,
                         version_imagebuilder)).read().decode('utf-8')))
+        except (OSError, ValueError) as error:
+            self.log.error("could not receive %s/%s targets: %s", distro, version, error)
+            return None
 
-                if version_config.get("active_targets"):
-                    version_targets = version_targets & set(version_config.get("active_targets"))
-
-                if version_config.get("ignore_targets"):
-                    version_targets = version_targets - set(version_config.get("ignore_targets"))
-                
-                self.log.info("add %s/%s targets", distro, version)
+        if version_config.get("active_targets"):
+            version_targets = version_targets & set(version_config.get("active_targets"))
 
-                # TODO do this at once instead of per target
-                for target in version_targets:
-                    self.log.debug("add %s/%s/%s", distro, version, target)
-                    self.database.insert_subtarget(distro, version, *target.split("/"))
+        if version_config.get("ignore_targets"):
+            version_targets = version_targets - set(version_config.get("ignore_targets"))
 
+        return version_targets
 
     def insert_board_rename(self):
         for distro, version in self.database.get_versions():
@@ -159,11 +197,10 @@ class ServerCli():
             version = str(version)
             version_replacements_path = os.path.join("distributions", distro, (version + ".yml"))
             if os.path.exists(version_replacements_path):
-                with open(version_replacements_path, "r") as version_replacements_file:
-                    replacements = yaml.load(version_replacements_file.read())
-                    if replacements:
-                        if "transformations" in replacements:
-                            self.insert_replacements(distro, version, replacements["transformations"])
+                replacements = load_yaml(version_replacements_path)
+                if replacements:
+                    if "transformations" in replacements:
+                        self.insert_replacements(distro, version, replacements["transformations"])
 
 if __name__ == "__main__":
     logging.basicConfig(level=logging.DEBUG)
@@ -7,4 +7,5 @@ import server
 from server import app
 
 if __name__ == '__main__':
-    app.run()
+    # development server, see server_threads in config.yml
+    app.run(threaded=True)
@@ -1,13 +1,43 @@
+from collections import OrderedDict
 from http import HTTPStatus
 from sys import getsizeof
+import logging
+import json
+from flask import Response
 
 from utils.image import Image
 from server.request import Request
 from utils.common import get_hash
 
+# status code and response of a failed build request, shared by single and
+# bulk build requests
+def build_error(config, request):
+    log = "{}/download/faillogs/faillog-{}.txt".format(config.get("server"), request["request_hash"])
+
+    if request["status"] == "build_fail":
+        return HTTPStatus.INTERNAL_SERVER_ERROR, { # 500
+                "error": "ImageBuilder faild to create image",
+                "log": log, "request_hash": request["request_hash"] }
+
+    # likely to many package where requested
+    elif request["status"] == "imagesize_fail":
+        return 413, { # PAYLOAD_TO_LARGE RCF 7231
+                "error": "No firmware created due to image size. Try again with less packages selected.",
+                "log": log, "request_hash": request["request_hash"] }
+
+    # something happend with is not yet covered in here
+    return HTTPStatus.INTERNAL_SERVER_ERROR, { "error": request["status"], "log": log }
+
 class BuildRequest(Request):
-    def __init__(self, config, db):
-        super().__init__(config, db)
+    def __init__(self, config, db, package_index, catalog, downloads=None):
+        super().__init__(config, db, package_index, catalog)
+        self.downloads = downloads
+
+    # nginx serves the download folder directly, so handing out the links
+    # is counted as download as well
+    def count_download(self, file_path):
+        if self.downloads:
+            self.downloads.count(file_path.rstrip("/"))
 
     def _process_request(self):
         self.log.debug("request_json: %s", self.request_json)
@@ -77,18 +107,18 @@ class BuildRequest(Request):
         # eventually this could be simplified if upstream unifirm the profiles/boards
         if "board" in self.request_json:
             self.log.debug("board in request, search for %s", self.request_json["board"])
-            self.request["profile"] = self.database.check_profile(self.request["distro"], self.request["version"], self.request["target"], self.request["subtarget"], self.request_json["board"])
+            self.request["profile"] = self.catalog.check_profile(self.request["distro"], self.request["version"], self.request["target"], self.request["subtarget"], self.request_json["board"])
 
         if not self.request["profile"]:
             if "model" in self.request_json:
                 self.log.debug("model in request, search for %s", self.request_json["model"])
-                self.request["profile"] = self.database.check_model(self.request["distro"], self.request["version"], self.request["target"], self.request["subtarget"], self.request_json["model"])
+                self.request["profile"] = self.catalog.check_model(self.request["distro"], self.request["version"], self.request["target"], self.request["subtarget"], self.request_json["model"])
                 self.log.debug("model search found profile %s", self.request["profile"])
 
         if not self.request["profile"]:
-            if self.database.check_profile(self.request["distro"], self.request["version"], self.request["target"], self.request["subtarget"], "Generic"):
+            if self.catalog.check_profile(self.request["distro"], self.request["version"], self.request["target"], self.request["subtarget"], "Generic"):
                 self.request["profile"] = "Generic"
-            elif self.database.check_profile(self.request["distro"], self.request["version"], self.request["target"], self.request["subtarget"], "generic"):
+            elif self.catalog.check_profile(self.request["distro"], self.request["version"], self.request["target"], self.request["subtarget"], "generic"):
                 self.request["profile"] = "generic"
             else:
                 self.response_json["error"] = "unknown device, please check model and board params"
@@ -119,6 +149,7 @@ class BuildRequest(Request):
         # image created, return all desired information
         if self.request["status"] == "created":
             image_path = self.database.get_image_path(self.request["image_hash"])
+            self.count_download(image_path["file_path"])
             self.response_json["sysupgrade"] = "{}/download/{}/{}".format(self.config.get("server"), image_path["file_path"], image_path["sysupgrade"])
             self.response_json["log"] = "{}/download/{}/buildlog-{}.txt".format(self.config.get("server"), image_path["file_path"], self.request["image_hash"])
             self.response_json["files"] = "{}/json/{}/".format(self.config.get("server"), image_path["file_path"])
@@ -136,6 +167,7 @@ class BuildRequest(Request):
             else:
                 # no sysupgrade found but not requested, factory image is likely from interest
                 image_path = self.database.get_image_path(self.request["image_hash"])
+                self.count_download(image_path["file_path"])
                 self.response_json["files"] = "{}/json/{}".format(self.config.get("server"), image_path["file_path"])
                 self.response_json["log"] = "{}/download/{}/buildlog-{}.txt".format(self.config.get("server"), image_path["file_path"], self.request["image_hash"])
                 self.response_json["request_hash"] = self.request["request_hash"]
@@ -157,26 +189,143 @@ class BuildRequest(Request):
             self.response_status = HTTPStatus.ACCEPTED # 202
 
         # build failed, see build log for details
-        elif self.request["status"] == "build_fail":
-            self.response_json["error"] = "ImageBuilder faild to create image"
-            self.response_json["log"] = "{}/download/faillogs/faillog-{}.txt".format(self.config.get("server"), self.request["request_hash"])
-            self.response_json["request_hash"] = self.request["request_hash"]
-
-            self.response_status = HTTPStatus.INTERNAL_SERVER_ERROR # 500
-
-        # likely to many package where requested
-        elif self.request["status"] == "imagesize_fail":
-            self.response_json["error"] = "No firmware created due to image size. Try again with less packages selected."
-            self.response_json["log"] = "{}/download/faillogs/faillog-{}.txt".format(self.config.get("server"), self.request["request_hash"])
-            self.response_json["request_hash"] = self.request["request_hash"]
-
-            self.response_status = 413 # PAYLOAD_TO_LARGE RCF 7231
-
-        # something happend with is not yet covered in here
         else:
-            self.response_json["error"] = self.request["status"]
-            self.response_json["log"] = "{}/download/faillogs/faillog-{}.txt".format(self.config.get("server"), self.request["request_hash"])
-
-            self.response_status = HTTPStatus.INTERNAL_SERVER_ERROR
+            self.response_status, error_json = build_error(self.config, self.request)
+            self.response_json.update(error_json)
 
         return self.respond()
+
+class BuildRequestBulk():
+    """Many build requests at once, e.g. to pre-seed all images of a release
+
+    Requests are grouped per subtarget. Distribution, version and target are
+    validated once per group, packages and profiles against the in memory
+    caches. Known requests of a group are fetched with one query and all new
+    ones are queued with a single insert. Results are returned in request
+    order.
+    """
+    def __init__(self, config, database, package_index, catalog):
+        self.config = config
+        self.database = database
+        self.package_index = package_index
+        self.catalog = catalog
+        self.log = logging.getLogger(__name__)
+
+    def respond(self, response_json, status):
+        return Response(response=json.dumps(response_json), status=status,
+                mimetype='application/json')
+
+    def error(self, status, message):
+        return { "status": status, "error": message }
+
+    def process_request(self, request_json):
+        if not isinstance(request_json, list):
+            return self.respond({"error": "expected a list of build requests"},
+                    HTTPStatus.BAD_REQUEST)
+
+        max_requests = self.config.get("build_request_bulk_size", 10000)
+        if len(request_json) > max_requests:
+            return self.respond({"error": "more than {} build requests".format(max_requests)},
+                    HTTPStatus.REQUEST_ENTITY_TOO_LARGE)
+
+        results = [None] * len(request_json)
+        groups = OrderedDict()
+        for index, spec in enumerate(request_json):
+            if not isinstance(spec, dict):
+                results[index] = self.error(HTTPStatus.BAD_REQUEST, "build request is not an object")
+                continue
+            missing = [param for param in ["distro", "version", "target", "subtarget", "board"]
+                    if param not in spec]
+            if missing:
+                results[index] = self.error(HTTPStatus.PRECONDITION_FAILED, "missing param " + missing[0])
+                continue
+            if spec.get("defaults"):
+                results[index] = self.error(HTTPStatus.BAD_REQUEST, "defaults are not supported in bulk requests")
+                continue
+            packages = spec.get("packages", [])
+            if not isinstance(packages, list) or not all(isinstance(package, str) for package in packages):
+                results[index] = self.error(HTTPStatus.BAD_REQUEST, "packages is not a list of names")
+                continue
+            subtarget = (str(spec["distro"]).lower(), spec["version"], spec["target"], spec["subtarget"])
+            groups.setdefault(subtarget, []).append(index)
+
+        new_images = []
+        for subtarget, indices in groups.items():
+            error = self.check_subtarget(*subtarget)
+            if error:
+                for index in indices:
+                    results[index] = error
+                continue
+
+            # same request_hash as a single build request would get
+            request_hashes = {}
+            for index in indices:
+                image = Image(dict(request_json[index], profile=request_json[index]["board"]))
+                image.set_packages_hash()
+                request_hashes[index] = (get_hash(" ".join(image.as_array("packages_hash")), 12), image)
+
+            known = self.database.get_build_requests([request_hash for request_hash, _ in request_hashes.values()])
+            for index in indices:
+                request_hash, image = request_hashes[index]
+                if request_hash in known:
+                    status = known[request_hash]["status"]
+                    if status in ["requested", "building"]:
+                        results[index] = { "status": HTTPStatus.ACCEPTED }
+                    elif status in ["created", "no_sysupgrade"]:
+                        results[index] = { "status": HTTPStatus.OK }
+                    else:
+                        code, error_json = build_error(self.config, known[request_hash])
+                        results[index] = dict(error_json, status=code)
+                    results[index].update(request_hash=request_hash, build_status=status)
+                    continue
+
+                new_image, error = self.check_image(subtarget, request_json[index], image)
+                if error:
+                    results[index] = error
+                    continue
+                new_image["request_hash"] = request_hash
+                new_images.append(new_image)
+                results[index] = { "status": HTTPStatus.ACCEPTED, "request_hash": request_hash,
+                        "build_status": "requested" }
+
+        if new_images:
+            self.database.add_build_jobs(new_images)
+
+        return self.respond(results, HTTPStatus.OK)
+
+    def check_subtarget(self, distro, version, target, subtarget):
+        if distro not in self.config.get_distros():
+            return self.error(HTTPStatus.PRECONDITION_FAILED, "unknown distribution %s" % distro)
+        if version not in self.config.get(distro).get("versions", []):
+            return self.error(HTTPStatus.PRECONDITION_FAILED, "unknown version %s" % version)
+        if self.catalog.sysupgrade_supported({ "distro": distro, "version": version,
+                "target": target, "subtarget": subtarget }) is None:
+            return self.error(HTTPStatus.PRECONDITION_FAILED, "unknown target %s/%s" % (target, subtarget))
+
+    # returns the image request to queue or an error
+    def check_image(self, subtarget, spec, image):
+        distro, version, target, subtarget = subtarget
+        packages = spec.get("packages", [])
+        new_image = { "distro": distro, "version": version, "target": target,
+                "subtarget": subtarget, "packages_hash": image.params["packages_hash"],
+                "packages": sorted(set(packages) - set(["libc", "kernel"])) }
+
+        packages_unknown = self.package_index.unknown_packages(new_image)
+        if packages_unknown:
+            return None, self.error(HTTPStatus.UNPROCESSABLE_ENTITY,
+                    "could not find packages '{}' for requested target".format(", ".join(packages_unknown)))
+
+        profile = self.catalog.check_profile(distro, version, target, subtarget, spec["board"])
+        if not profile and "model" in spec:
+            profile = self.catalog.check_model(distro, version, target, subtarget, spec["model"])
+        if not profile:
+            for generic in ["Generic", "generic"]:
+                if self.catalog.check_profile(distro, version, target, subtarget, generic):
+                    profile = generic
+                    break
+        if not profile:
+            return None, self.error(HTTPStatus.PRECONDITION_FAILED,
+                    "unknown device, please check model and board params")
+
+        new_image["profile"] = profile
+        return new_image, None
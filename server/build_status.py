@@ -0,0 +1,110 @@
+from queue import Queue, Empty
+import threading
+import logging
+import time
+
+from utils.database import Listener
+
+# statuses of requests which are not finished yet
+PENDING = ["requested", "building"]
+
+class BuildStatusHub():
+    """Fan out build status changes to waiting clients
+
+    A single Listener per server process receives the notifications of the
+    image_requests_status trigger and wakes all clients waiting on the request,
+    so waiting clients don't query the database. Without a listen connection
+    the status is polled every `keepalive` seconds instead.
+
+    Every waiting client occupies a server thread, so at most `max_streams`
+    clients wait at once and the remaining threads serve the regular API.
+    """
+    def __init__(self, config, database, keepalive=15, max_streams=2):
+        self.log = logging.getLogger(__name__)
+        self.config = config
+        self.database = database
+        self.keepalive = keepalive
+        self.max_streams = max_streams
+        self.streams = 0
+        self.lock = threading.Lock()
+        # request_hash: set of queues of waiting clients
+        self.waiting = {}
+        self.listener = None
+        self.thread = None
+
+    @property
+    def listening(self):
+        return self.listener is not None and self.listener.cnxn is not None
+
+    # started on first use, so every forked server process runs its own
+    def start(self):
+        with self.lock:
+            if not self.thread:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+
+    def run(self):
+        self.listener = Listener(self.config, "image_requests_status")
+        while True:
+            for payload in self.listener.wait(60):
+                request_hash, _, status = payload.partition(" ")
+                with self.lock:
+                    queues = list(self.waiting.get(request_hash, []))
+                for queue in queues:
+                    queue.put(status)
+
+    # reserves a stream, returns False if max_streams clients wait already
+    def open_stream(self):
+        with self.lock:
+            if self.streams >= self.max_streams:
+                return False
+            self.streams += 1
+            return True
+
+    def close_stream(self):
+        with self.lock:
+            self.streams -= 1
+
+    def subscribe(self, request_hash):
+        self.start()
+        queue = Queue()
+        with self.lock:
+            self.waiting.setdefault(request_hash, set()).add(queue)
+        return queue
+
+    def unsubscribe(self, request_hash, queue):
+        with self.lock:
+            queues = self.waiting.get(request_hash)
+            if queues:
+                queues.discard(queue)
+                if not queues:
+                    del self.waiting[request_hash]
+
+    # yields the current status of a request and all following changes until
+    # it's finished or timeout seconds passed. None is yielded every keepalive
+    # seconds without change. yields nothing for unknown requests
+    def statuses(self, request_hash, timeout):
+        # subscribe first to not miss a change right after the query
+        queue = self.subscribe(request_hash)
+        try:
+            status = self.database.get_build_request_status(request_hash)
+            deadline = time.time() + timeout
+            while status:
+                yield status
+                if status not in PENDING:
+                    return
+
+                current = status
+                while status == current:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return
+                    try:
+                        status = queue.get(timeout=min(remaining, self.keepalive))
+                    except Empty:
+                        if not self.listening:
+                            status = self.database.get_build_request_status(request_hash)
+                        if status == current:
+                            yield None
+        finally:
+            self.unsubscribe(request_hash, queue)
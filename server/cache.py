@@ -0,0 +1,166 @@
+from collections import OrderedDict
+from re import sub
+import threading
+import logging
+import time
+import sys
+
+class SubtargetCache():
+    """Per subtarget cache, entries stay valid while last_sync is unchanged
+
+    The sync state of all subtargets is polled from the database at most
+    every `ttl` seconds, so an Updater run becomes visible after that delay.
+    Entries are created lazily via `load()` and the least recently used ones
+    are dropped once more than `size` subtargets are cached.
+    """
+    def __init__(self, database, ttl=60, size=64):
+        self.log = logging.getLogger(__name__)
+        self.database = database
+        self.ttl = ttl
+        self.size = size
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.subtargets = {}
+        self.subtargets_checked = 0
+
+    # returns { (distro, version, target, subtarget): (supported, last_sync) }
+    def sync_state(self):
+        if time.time() - self.subtargets_checked > self.ttl:
+            subtargets = {}
+            for distro, version, target, subtarget, supported, last_sync in self.database.get_subtargets_sync():
+                subtargets[(distro, version, target, subtarget)] = (supported, last_sync)
+            with self.lock:
+                self.subtargets = subtargets
+                self.subtargets_checked = time.time()
+        return self.subtargets
+
+    def load(self, key):
+        pass
+
+    # returns None for subtargets unknown to the database
+    def get(self, key):
+        state = self.sync_state().get(key)
+        if not state:
+            return None
+
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and entry[0] == state[1]:
+                self.entries.move_to_end(key)
+                return entry[1]
+
+        self.log.debug("load %s for %s", self.__class__.__name__, key)
+        value = self.load(key)
+
+        with self.lock:
+            self.entries[key] = (state[1], value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+        return value
+
+class PackageIndex(SubtargetCache):
+    """Available packages and their versions per subtarget"""
+    def load(self, key):
+        packages = self.database.get_packages_available(*key)
+        # package names are shared between many subtargets, store them once
+        return { sys.intern(name): version for name, version in packages.items() }
+
+    # returns requested packages not available for the subtarget
+    def unknown_packages(self, image):
+        key = (image["distro"], image["version"], image["target"], image["subtarget"])
+        available = self.get(key)
+
+        # subtarget not (yet) synced, let the database decide
+        if not available:
+            return self.database.check_packages(image)
+
+        # a leading - explicitly removes packages installed per default
+        requested = set([sub(r'^-?', '', p) for p in image["packages"]])
+        return sorted(requested - available.keys())
+
+class TargetCatalog(SubtargetCache):
+    """Profiles, lowercase models and board renames per subtarget
+
+    Support of subtargets is answered from the polled sync state directly.
+    """
+    def load(self, key):
+        distro, version, target, subtarget = key
+        entry = { "profiles": set(), "models": {}, "renames": {} }
+        for profile, model in self.database.get_profiles(*key):
+            entry["profiles"].add(profile)
+            entry["models"].setdefault(model.lower(), profile)
+        for origname, newname in self.database.get_board_renames(distro, version):
+            entry["renames"][origname] = newname
+        return entry
+
+    # returns None if the subtarget is unknown
+    def sysupgrade_supported(self, image):
+        key = (image["distro"], image["version"], image["target"], image["subtarget"])
+        state = self.sync_state().get(key)
+        if not state:
+            # subtarget may be added since the last poll
+            return self.database.sysupgrade_supported(image)
+        return state[0]
+
+    def check_profile(self, distro, version, target, subtarget, profile):
+        entry = self.get((distro, version, target, subtarget))
+        if entry is None:
+            return self.database.check_profile(distro, version, target, subtarget, profile)
+        profile = entry["renames"].get(profile, profile)
+        if profile in entry["profiles"]:
+            return profile
+
+    def check_model(self, distro, version, target, subtarget, model):
+        entry = self.get((distro, version, target, subtarget))
+        if entry is None:
+            return self.database.check_model(distro, version, target, subtarget, model)
+        return entry["models"].get(model.lower())
+
+class ResponseCache():
+    """Finished responses of requests that only depend on subtarget data
+
+    Entries remember the sync state of the subtargets their response was
+    created from. They're dropped once the Updater synced one of these
+    subtargets, as polled by `catalog`, or after `ttl` seconds. Only the `size`
+    most recently used responses are kept.
+    """
+    def __init__(self, catalog, ttl=3600, size=10000):
+        self.catalog = catalog
+        self.ttl = ttl
+        self.size = size
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+
+    # snapshot of the sync state, taken before creating a response
+    def sync_state(self):
+        return self.catalog.sync_state()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+        if not entry:
+            return None
+
+        created, subtargets, state, response = entry
+        sync_state = self.sync_state()
+        if (time.time() - created > self.ttl or
+                tuple(sync_state.get(subtarget) for subtarget in subtargets) != state):
+            with self.lock:
+                if self.entries.get(key) is entry:
+                    del self.entries[key]
+            return None
+
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+        return response
+
+    # subtargets can be unknown, the response is then dropped once they appear
+    def put(self, key, subtargets, response, sync_state):
+        state = tuple(sync_state.get(subtarget) for subtarget in subtargets)
+        with self.lock:
+            self.entries[key] = (time.time(), subtargets, state, response)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
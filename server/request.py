@@ -4,9 +4,11 @@ import json
 from flask import Response
 
 class Request():
-    def __init__(self, config, database):
+    def __init__(self, config, database, package_index, catalog):
         self.config = config
         self.database = database
+        self.package_index = package_index
+        self.catalog = catalog
         self.log = logging.getLogger(__name__)
 
     def process_request(self, request_json, sysupgrade_requested=False):
@@ -26,7 +28,7 @@ class Request():
         # I'm considering a dict request is faster than asking the database
         self.request["distro"] = self.request_json["distro"].lower()
         if not self.request["distro"] in self.config.get_distros():
-            self.response_json["error"] = "unknown distribution %s" % self.distro
+            self.response_json["error"] = "unknown distribution %s" % self.request["distro"]
             self.response_status = HTTPStatus.PRECONDITION_FAILED # 412
             return self.respond()
 
@@ -50,7 +52,7 @@ class Request():
         self.request["subtarget"] = self.request_json["subtarget"]
 
         # check if sysupgrade is supported. If None is returned the subtarget isn't found
-        sysupgrade_supported = self.database.sysupgrade_supported(self.request)
+        sysupgrade_supported = self.catalog.sysupgrade_supported(self.request)
         if sysupgrade_supported == None:
             self.response_json["error"] = "unknown target %s/%s" % (self.request["target"], self.request["subtarget"])
             self.response_status = HTTPStatus.PRECONDITION_FAILED # 412
@@ -81,7 +83,8 @@ class Request():
         # all checks passed, not bad
         return False
 
-    # check packages by sending requested packages again postgres
+    # check packages against the in memory index of available packages, which
+    # falls back to postgres for subtargets not yet synced
     def check_bad_packages(self):
         # remove packages which doesn't exists but appear in the package list
         # upgrade_checks send a dict with package name & version while build
@@ -92,13 +95,13 @@ class Request():
             packages_set = set(self.request_json["packages"]) - set(["libc", "kernel"])
 
         self.request["packages"] = sorted(list(packages_set))
-        packages_unknown = self.database.check_packages(self.request)
+        packages_unknown = self.package_index.unknown_packages(self.request)
 
         # if list is not empty there where some unknown packages found
         if packages_unknown:
             logging.warning("could not find packages %s", packages_unknown)
             self.response_header["X-Unknown-Package"] = ", ".join(packages_unknown)
-            self.response_json["error"] = "could not find packages '{}' for requested target".format(packages_unknown)
+            self.response_json["error"] = "could not find packages '{}' for requested target".format(", ".join(packages_unknown))
             self.response_status = HTTPStatus.UNPROCESSABLE_ENTITY # 422
             return self.respond()
 
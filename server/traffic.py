@@ -0,0 +1,73 @@
+from collections import Counter
+import threading
+import atexit
+import logging
+import time
+
+class BatchCounter():
+    """Count events in memory and pass them to `store` every `interval` seconds
+
+    Used for statistics collected on hot paths, like upgrade checks answered
+    from cache or image downloads, so they don't cause a database write each.
+    A thread flushes the counts, also if no further events arrive, and the
+    remaining counts are flushed on exit.
+    """
+    def __init__(self, store, interval=60):
+        self.log = logging.getLogger(__name__)
+        self.store = store
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.counts = Counter()
+        self.thread = None
+
+    # started on first use, so every forked server process runs its own
+    def start(self):
+        with self.lock:
+            if not self.thread:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+                atexit.register(self.flush)
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            self.flush()
+
+    def count(self, key):
+        if not self.thread:
+            self.start()
+        with self.lock:
+            self.counts[key] += 1
+
+    def flush(self):
+        with self.lock:
+            if not self.counts:
+                return
+            counts, self.counts = self.counts, Counter()
+
+        try:
+            self.store(counts)
+        except Exception:
+            self.log.exception("could not store counts")
+            # retried with the next flush
+            with self.lock:
+                self.counts.update(counts)
+
+class UpgradeCheckCounter(BatchCounter):
+    """Count upgrade checks per subtarget"""
+    def __init__(self, database, interval=60):
+        super().__init__(database.add_upgrade_check_stats, interval)
+
+    def count(self, request_json):
+        try:
+            subtarget = tuple(str(request_json[key]) for key in
+                    ["distro", "version", "target", "subtarget"])
+        except (KeyError, TypeError):
+            return
+        super().count(subtarget)
+
+class DownloadCounter(BatchCounter):
+    """Count downloads per image folder, used by the GarbageCollector to evict
+    least recently downloaded images first"""
+    def __init__(self, database, interval=60):
+        super().__init__(database.add_image_downloads, interval)
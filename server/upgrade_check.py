@@ -1,13 +1,41 @@
+from collections import OrderedDict
 from http import HTTPStatus
 import logging
+import json
+from flask import Response
 
 from server.request import Request
 from utils.common import get_hash
 
+# returns manifest_hash and check_hash of an upgrade check
+def get_check_hash(request_json):
+    # recreate manifest based on requested packages
+    manifest_content = ""
+    for package, version in sorted(request_json["packages"].items()):
+        manifest_content += "{} - {}\n".format(package, version)
+
+    manifest_hash = get_hash(manifest_content, 15)
+
+    # distro version target subtarget profile manifest_hash
+    upgrade_check_hash_array = [
+            request_json["distro"],
+            request_json["version"],
+            request_json["target"],
+            request_json["subtarget"],
+            manifest_hash
+            ]
+
+    # create hash of the upgrade check
+    return manifest_hash, get_hash(" ".join(upgrade_check_hash_array), 15)
+
 class UpgradeCheck(Request):
-    def __init__(self, config, db):
-        super().__init__(config, db)
+    # upgrade_checks are prefetched { check_hash: upgrade check }, checks
+    # missing there are considered unknown to the database
+    def __init__(self, config, db, package_index, catalog, responses=None, upgrade_checks=None):
+        super().__init__(config, db, package_index, catalog)
         self.log = logging.getLogger(__name__)
+        self.responses = responses
+        self.upgrade_checks = upgrade_checks
 
     # check if requested version is a snapshot
     # TODO check revision for snapshots to not continiously upgrade them
@@ -26,36 +54,55 @@ class UpgradeCheck(Request):
         if missing_params:
             return self.respond()
 
-        # recreate manifest based on requested packages
-        manifest_content = ""
-        for package, version in sorted(self.request_json["packages"].items()):
-            manifest_content += "{} - {}\n".format(package, version)
-
-        self.request["manifest_hash"] = get_hash(manifest_content, 15)
-
-        # distro version target subtarget profile manifest_hash
-        upgrade_check_hash_array = [
-                self.request_json["distro"],
-                self.request_json["version"],
-                self.request_json["target"],
-                self.request_json["subtarget"],
-                self.request["manifest_hash"]
-                ]
-
-        # create hash of the upgrade check
-        self.request["check_hash"] = get_hash(" ".join(upgrade_check_hash_array), 15)
-
+        self.request["manifest_hash"], self.request["check_hash"] = get_check_hash(self.request_json)
+
+        if not self.responses:
+            return self.check_upgrade()
+
+        # answer repeated checks from memory, including failed ones
+        key = (self.request["check_hash"], "upgrade_packages" in self.request_json)
+        cached = self.responses.get(key)
+        if cached:
+            self.response_status, self.response_json, self.response_header = cached
+            return self.respond(json_content=True)
+
+        sync_state = self.responses.sync_state()
+        response = self.check_upgrade()
+        if response.status_code < HTTPStatus.INTERNAL_SERVER_ERROR:
+            self.responses.put(key, self.request_subtargets(), (self.response_status,
+                response.get_data(as_text=True), dict(self.response_header)), sync_state)
+        return response
+
+    # subtargets of the installed and the offered version
+    def request_subtargets(self):
+        distro = self.request.get("distro", str(self.request_json["distro"]).lower())
+        subtargets = set()
+        for version in [self.request_json["version"], self.request.get("version")]:
+            if version:
+                subtargets.add((distro, version, self.request_json["target"], self.request_json["subtarget"]))
+        return tuple(subtargets)
+
+    def check_upgrade(self):
         # check database for cached upgrade check
-        upgrade_check = self.database.check_upgrade_check_hash(self.request["check_hash"])
+        if self.upgrade_checks is not None:
+            upgrade_check = self.upgrade_checks.get(self.request["check_hash"])
+        else:
+            upgrade_check = self.database.check_upgrade_check_hash(self.request["check_hash"])
         if upgrade_check:
             self.request = upgrade_check
 
             # check latest version for request
+            self.installed_version = self.request_json["version"]
             self.distro_latest_version()
 
             if self.request["upgrades"]:
                 # set upgrade json created by postgresql
-                self.response_json["upgrades"] = self.request["upgrades"]
+                self.response_json["upgrades"] = json.loads(self.request["upgrades"])
+
+            if "version" in self.response_json or "upgrades" in self.response_json:
+                self.response_status = HTTPStatus.OK # 200
+            else:
+                self.response_status = HTTPStatus.NO_CONTENT # 204
 
             # instantly respond
             return self.respond()
@@ -94,7 +141,8 @@ class UpgradeCheck(Request):
         # TODO this is confusing as request_json[packages] contains package
         # names + version while the validated packages of request[packages] only
         # contain the names...
-        self.database.add_manifest_packages(self.image.params["manifest_hash"], self.request_json["packages"])
+        self.database.add_manifest_packages(self.request["manifest_hash"], self.request_json["packages"])
+        self.database.insert_manifest_upgrades(self.request)
 
         # only check for package upgrades if activle requested by the client or version jump
         if "upgrade_packages" in self.request_json or "version" in self.response_json:
@@ -102,7 +150,7 @@ class UpgradeCheck(Request):
             package_upgrades = self.database.manifest_outdated(self.request)
             if package_upgrades:
                 self.response_json["upgrades"] = {}
-                for name, current, outdated in package_upgrades:
+                for name, (current, outdated) in json.loads(package_upgrades).items():
                     # the "upgrades" should be visually displayed to the client
                     # so save bandwidth the format is simply
                     # { "package_name": [ "new_version", "old_version" ], ... }
@@ -132,3 +180,76 @@ class UpgradeCheck(Request):
 
         # finally respond
         return self.respond()
+
+class UpgradeCheckBatch():
+    """Upgrade checks of many devices in a single request
+
+    Checks are grouped per subtarget and processed by UpgradeCheck. The
+    upgrade checks already known for a group are fetched with one query, the
+    package index of the subtarget is loaded once and repeated manifests are
+    answered by the response cache. Results are returned in request order.
+    """
+    def __init__(self, config, database, package_index, catalog, responses=None):
+        self.config = config
+        self.database = database
+        self.package_index = package_index
+        self.catalog = catalog
+        self.responses = responses
+        self.log = logging.getLogger(__name__)
+
+    def respond(self, response_json, status):
+        return Response(response=json.dumps(response_json), status=status,
+                mimetype='application/json')
+
+    def process_request(self, request_json):
+        if not isinstance(request_json, list):
+            return self.respond({"error": "expected a list of upgrade checks"},
+                    HTTPStatus.BAD_REQUEST)
+
+        max_checks = self.config.get("upgrade_check_batch_size", 5000)
+        if len(request_json) > max_checks:
+            return self.respond({"error": "more than {} upgrade checks".format(max_checks)},
+                    HTTPStatus.REQUEST_ENTITY_TOO_LARGE)
+
+        results = [None] * len(request_json)
+        groups = OrderedDict()
+        for index, check in enumerate(request_json):
+            if not isinstance(check, dict):
+                results[index] = { "status": HTTPStatus.BAD_REQUEST,
+                        "response": { "error": "upgrade check is not an object" }}
+                continue
+            subtarget = tuple(str(check.get(key)) for key in
+                    ["distro", "version", "target", "subtarget"])
+            groups.setdefault(subtarget, []).append(index)
+
+        for subtarget, indices in groups.items():
+            check_hashes = []
+            for index in indices:
+                try:
+                    check_hashes.append(get_check_hash(request_json[index])[1])
+                except (KeyError, AttributeError, TypeError):
+                    pass
+            upgrade_checks = {}
+            if check_hashes:
+                upgrade_checks = self.database.check_upgrade_check_hashes(check_hashes)
+
+            for index in indices:
+                results[index] = self.check(request_json[index], upgrade_checks)
+
+        return self.respond(results, HTTPStatus.OK)
+
+    def check(self, request_json, upgrade_checks):
+        try:
+            response = UpgradeCheck(self.config, self.database, self.package_index,
+                    self.catalog, self.responses, upgrade_checks).process_request(request_json)
+        except Exception:
+            self.log.exception("upgrade check failed")
+            return { "status": HTTPStatus.INTERNAL_SERVER_ERROR, "response": {} }
+
+        body = response.get_data(as_text=True)
+        result = { "status": response.status_code, "response": json.loads(body) if body else {} }
+        # e.g. X-Missing-Param or X-Unknown-Package
+        headers = { key: value for key, value in response.headers.items() if key.startswith("X-") }
+        if headers:
+            result["headers"] = headers
+        return result
@@ -6,8 +6,11 @@ import json
 import os
 from http import HTTPStatus
 
-from server.build_request import BuildRequest
-from server.upgrade_check import UpgradeCheck
+from server.build_request import BuildRequest, BuildRequestBulk
+from server.upgrade_check import UpgradeCheck, UpgradeCheckBatch
+from server.cache import PackageIndex, TargetCatalog, ResponseCache
+from server.build_status import BuildStatusHub, PENDING
+from server.traffic import UpgradeCheckCounter, DownloadCounter
 from server import app
 
 from utils.config import Config
@@ -15,9 +18,19 @@ from utils.database import Database
 
 config = Config()
 database = Database(config)
+package_index = PackageIndex(database, config.get("cache_ttl", 60),
+        config.get("package_index_size", 64))
+catalog = TargetCatalog(database, config.get("cache_ttl", 60),
+        config.get("catalog_size", 1024))
+responses = ResponseCache(catalog, config.get("response_cache_ttl", 3600),
+        config.get("response_cache_size", 10000))
+upgrade_checks = UpgradeCheckCounter(database, config.get("cache_ttl", 60))
+downloads = DownloadCounter(database, config.get("cache_ttl", 60))
+build_status = BuildStatusHub(config, database, config.get("build_status_keepalive", 15),
+        config.get("build_status_streams", 2))
 
-uc = UpgradeCheck(config, database)
-br = BuildRequest(config, database)
+# handlers keep per request state, so every request gets its own instance
+# while config, database (connection pool) and caches are shared between threads
 
 @app.route("/update-request", methods=['POST'])
 @app.route("/api/upgrade-check", methods=['POST'])
@@ -28,15 +41,29 @@ def api_upgrade_check(request_hash=None):
             request_json = json.loads(request.get_data().decode('utf-8'))
         except:
             return "[]", HTTPStatus.BAD_REQUEST
+        upgrade_checks.count(request_json)
     else:
         if not request_hash:
             return "[]", HTTPStatus.BAD_REQUEST
         request_json = { "request_hash": request_hash }
-    return uc.process_request(request_json)
+    return UpgradeCheck(config, database, package_index, catalog, responses).process_request(request_json)
+
+# upgrade checks of many devices, answered as list in request order
+@app.route("/api/upgrade-check/batch", methods=['POST'])
+def api_upgrade_check_batch():
+    try:
+        request_json = json.loads(request.get_data().decode('utf-8'))
+    except:
+        return "[]", HTTPStatus.BAD_REQUEST
+    if isinstance(request_json, list):
+        for check in request_json:
+            upgrade_checks.count(check)
+    return UpgradeCheckBatch(config, database, package_index, catalog, responses).process_request(request_json)
 
 # direct link to download a specific image based on hash
 @app.route("/download/<path:image_path>/<path:image_name>")
 def download_image(image_path, image_name):
+    downloads.count(os.path.dirname(os.path.join(image_path, image_name)))
     return send_from_directory(directory=os.path.join(config.get_folder("download_folder"), image_path), filename=image_name)
 
 # request methos for individual image
@@ -58,7 +85,7 @@ def api_upgrade_request(request_hash=None):
             return "[]", HTTPStatus.BAD_REQUEST
         request_json = { "request_hash": request_hash }
 
-    return br.process_request(request_json, sysupgrade_requested=1)
+    return BuildRequest(config, database, package_index, catalog, downloads).process_request(request_json, sysupgrade_requested=1)
 
 @app.route("/api/")
 @app.route("/stats")
@@ -78,7 +105,91 @@ def api_files_request(request_hash=None):
         if not request_hash:
             return "[]", HTTPStatus.BAD_REQUEST
         request_json = { "request_hash": request_hash }
-    return br.process_request(request_json)
+    return BuildRequest(config, database, package_index, catalog, downloads).process_request(request_json)
+
+# finished requests return the same as GET /api/build-request/<request_hash>
+def build_status_json(request_hash, status):
+    status_json = { "request_hash": request_hash, "status": status }
+    if status not in PENDING:
+        response = BuildRequest(config, database, package_index, catalog, downloads).process_request(
+                { "request_hash": request_hash })
+        status_json.update(json.loads(response.get_data(as_text=True) or "{}"))
+    return status_json
+
+# clients exceeding build_status_streams poll GET /api/build-request/<request_hash>
+def build_status_busy():
+    return "[]", HTTPStatus.SERVICE_UNAVAILABLE, {
+            "Retry-After": str(config.get("build_status_keepalive", 15)) }
+
+# server-sent events of all status changes of a build request until it's
+# finished, instead of polling
+@app.route("/api/build-request/<request_hash>/events")
+def api_build_request_events(request_hash):
+    if not build_status.open_stream():
+        return build_status_busy()
+
+    statuses = build_status.statuses(request_hash, config.get("build_status_timeout", 600))
+    try:
+        status = next(statuses, None)
+    except:
+        build_status.close_stream()
+        raise
+    if not status:
+        statuses.close()
+        build_status.close_stream()
+        return "[]", HTTPStatus.NOT_FOUND
+
+    def stream(status):
+        yield "event: {}\ndata: {}\n\n".format(status, json.dumps(build_status_json(request_hash, status)))
+        for status in statuses:
+            if status:
+                yield "event: {}\ndata: {}\n\n".format(status, json.dumps(build_status_json(request_hash, status)))
+            else:
+                yield ": keepalive\n\n"
+
+    response = app.response_class(stream(status), mimetype="text/event-stream",
+            headers={ "Cache-Control": "no-cache", "X-Accel-Buffering": "no" })
+    # also called if the client disconnects before the stream started
+    response.call_on_close(statuses.close)
+    response.call_on_close(build_status.close_stream)
+    return response
+
+# long-poll fallback of the events, returns once the status differs from the
+# status passed by the client or after timeout seconds
+@app.route("/api/build-request/<request_hash>/wait")
+def api_build_request_wait(request_hash):
+    known = request.args.get("status")
+    try:
+        timeout = min(float(request.args.get("timeout", 30)), config.get("build_status_wait_max", 60))
+    except ValueError:
+        return "[]", HTTPStatus.BAD_REQUEST
+
+    if not build_status.open_stream():
+        return build_status_busy()
+
+    last = None
+    statuses = build_status.statuses(request_hash, timeout)
+    try:
+        for status in statuses:
+            if status:
+                last = status
+                if status != known:
+                    break
+    finally:
+        statuses.close()
+        build_status.close_stream()
+    if not last:
+        return "[]", HTTPStatus.NOT_FOUND
+    return mime_json(json.dumps(build_status_json(request_hash, last)))
+
+# queue many images at once, answered as list in request order
+@app.route("/api/build-request/bulk", methods=['POST'])
+def api_build_request_bulk():
+    try:
+        request_json = json.loads(request.get_data().decode('utf-8'))
+    except:
+        return "[]", HTTPStatus.BAD_REQUEST
+    return BuildRequestBulk(config, database, package_index, catalog).process_request(request_json)
 
 @app.route("/")
 def root_path():
@@ -108,6 +219,10 @@ def mime_json(response):
 def api_stats_popular_targets():
     return mime_json(database.get_popular_targets())
 
+@app.route("/api/v1/stats/workers")
+def api_stats_workers():
+    return mime_json(database.get_worker_utilization())
+
 @app.route("/api/v1/stats/popular_packages")
 def api_stats_popular_packages():
     return mime_json(database.get_popular_packages())
@@ -0,0 +1,15 @@
+#!/usr/bin/env python3
+import logging
+logging.basicConfig(level=logging.INFO)
+
+# serves the waiting build status clients next to the api, nginx routes
+# /api/build-request/<request_hash>/(events|wait) here. the threads mostly
+# sleep, so every one of them may hold a stream
+import server
+from server import app
+from server.views import build_status, config
+
+build_status.max_streams = config.get("status_threads", 256)
+
+if __name__ == '__main__':
+    app.run(port=5002, threaded=True)
@@ -0,0 +1,100 @@
+# checks the Updater's sources against local stand-ins of the mirrors, run
+# with: python3 -m unittest discover tests
+import gzip
+import io
+import os
+import shutil
+import sys
+import tarfile
+import tempfile
+import unittest
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root)
+
+from utils.parser import parse_packages_index, parse_packages_folder
+
+INDEX = """Package: busybox
+Version: 1.28.4-3
+Depends: libc
+Size: 218421
+Description: The Swiss Army Knife
+ of embedded Linux
+
+Package: base-files
+Version: 194.2-r7676
+Size: 43821
+"""
+
+def add_file(tar, name, content):
+    info = tarfile.TarInfo(name)
+    info.size = len(content)
+    tar.addfile(info, io.BytesIO(content))
+
+class PackagesIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def expected(self):
+        return [("busybox", "1.28.4-3", 218421), ("base-files", "194.2-r7676", 43821)]
+
+    def test_plain_and_gzip_index(self):
+        with open(os.path.join(self.folder, "Packages"), "w") as index_file:
+            index_file.write(INDEX)
+        with gzip.open(os.path.join(self.folder, "Packages.gz"), "wt") as index_file:
+            index_file.write(INDEX)
+        for index in ["Packages", "Packages.gz"]:
+            self.assertEqual(list(parse_packages_index(os.path.join(self.folder, index))),
+                    self.expected())
+
+    # the ImageBuilder creates the index of its local packages on first build
+    def test_folder_without_index(self):
+        control = io.BytesIO()
+        with tarfile.open(fileobj=control, mode="w:gz") as control_tar:
+            add_file(control_tar, "./control", b"Package: kmod-e1000\nVersion: 4.14.63-1\n")
+        with tarfile.open(os.path.join(self.folder, "kmod-e1000_4.14.63-1_x86_64.ipk"), "w:gz") as ipk:
+            add_file(ipk, "./debian-binary", b"2.0\n")
+            add_file(ipk, "./control.tar.gz", control.getvalue())
+        self.assertEqual(list(parse_packages_folder(self.folder)),
+                [("kmod-e1000", "4.14.63-1", None)])
+
+        with open(os.path.join(self.folder, "Packages"), "w") as index_file:
+            index_file.write(INDEX)
+        self.assertEqual(list(parse_packages_folder(self.folder)), self.expected())
+
+class FingerprintTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        # utils.common reads config.yml of the working directory on import
+        cls.cwd = os.getcwd()
+        cls.folder = tempfile.mkdtemp()
+        shutil.copy(os.path.join(root, "utils/config.yml.default"),
+                os.path.join(cls.folder, "config.yml"))
+        os.chdir(cls.folder)
+        global get_fingerprint
+        from utils.common import get_fingerprint
+
+    @classmethod
+    def tearDownClass(cls):
+        os.chdir(cls.cwd)
+        shutil.rmtree(cls.folder)
+
+    def test_local_mirror(self):
+        path = os.path.join(self.folder, "Packages.gz")
+        with gzip.open(path, "wt") as index_file:
+            index_file.write(INDEX)
+        url = "file://" + path
+
+        fingerprint = get_fingerprint([url])
+        self.assertTrue(fingerprint)
+        self.assertEqual(get_fingerprint([url]), fingerprint)
+
+        os.utime(path, (0, 0))
+        self.assertNotEqual(get_fingerprint([url]), fingerprint)
+        self.assertIsNone(get_fingerprint([url, url + ".missing"]))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,88 @@
+import hashlib
+import logging
+import os
+import stat
+
+class BlobStore():
+    """Content addressed store of image files
+
+    Files are stored once below `download_folder/.blobs`, named by their
+    sha256 sum. Image folders contain hardlinks to these blobs, so kernels or
+    factory images which don't change between manifests use disk space and
+    page cache only once. The link count of a blob is its reference count, a
+    blob linked only from the store is unused and removed by `sweep()`.
+    """
+    def __init__(self, config):
+        self.log = logging.getLogger(__name__)
+        self.folder = os.path.join(config.get_folder("download_folder"), ".blobs")
+        self.min_size = config.get("blob_min_size", 65536)
+        self.enabled = config.get("blob_store", True)
+
+    def blob_path(self, sha256):
+        return os.path.join(self.folder, sha256[:2], sha256[2:])
+
+    def file_hash(self, path):
+        h = hashlib.sha256()
+        with open(path, "rb") as blob_file:
+            for chunk in iter(lambda: blob_file.read(1024 * 1024), b""):
+                h.update(chunk)
+        return h.hexdigest()
+
+    # replace path by a link to an equal blob or add it as new blob. returns
+    # the bytes saved
+    def add(self, path):
+        st = os.lstat(path)
+        if not stat.S_ISREG(st.st_mode) or st.st_size < self.min_size:
+            return 0
+
+        blob = self.blob_path(self.file_hash(path))
+        os.makedirs(os.path.dirname(blob), exist_ok=True)
+
+        # the first copy becomes the blob
+        try:
+            os.link(path, blob)
+            return 0
+        except FileExistsError:
+            pass
+        except OSError as e:
+            self.log.warning("could not store %s: %s", path, e)
+            return 0
+
+        if os.path.samefile(path, blob):
+            return 0
+
+        # link next to the file and rename it over, so the file is never missing
+        link_path = path + ".blob"
+        try:
+            os.link(blob, link_path)
+        except OSError as e:
+            # removed by the GarbageCollector meanwhile or too many links
+            self.log.warning("could not link %s: %s", blob, e)
+            return 0
+        os.replace(link_path, path)
+        return st.st_size
+
+    def add_folder(self, folder):
+        if not self.enabled:
+            return 0
+        saved = 0
+        for entry in os.scandir(folder):
+            saved += self.add(entry.path)
+        self.log.debug("deduplicated %d bytes of %s", saved, folder)
+        return saved
+
+    # remove blobs which are not linked from any image folder. returns the
+    # bytes freed
+    def sweep(self):
+        freed = 0
+        if not os.path.exists(self.folder):
+            return freed
+        for prefix in os.scandir(self.folder):
+            for entry in os.scandir(prefix.path):
+                st = entry.stat(follow_symlinks=False)
+                if st.st_nlink == 1:
+                    os.remove(entry.path)
+                    freed += st.st_size
+        if freed:
+            self.log.info("removed %d bytes of unused blobs", freed)
+        return freed
@@ -1,7 +1,10 @@
 import urllib.request
 import hashlib
+import errno
+import fcntl
 import os
 import os.path
+import shutil
 import subprocess
 import urllib
 from email.utils import parsedate
@@ -40,6 +43,71 @@ def get_last_modified(url):
     if headers:
         return datetime(*parsedate(headers["last-modified"])[:6])
 
+def get_fingerprint(urls):
+    """hash of ETag or Last-Modified of all urls, content is hashed if a server
+    sends neither. returns None if an url is unavailable"""
+    validators = []
+    for url in urls:
+        try:
+            response = urllib.request.urlopen(url)
+        except (urllib.error.URLError, OSError):
+            return None
+        with response:
+            headers = response.info()
+            validator = headers["etag"] or headers["last-modified"]
+            if not validator:
+                validator = hashlib.sha256(response.read()).hexdigest()
+        validators.append("{} {}".format(url, validator))
+    return get_hash("\n".join(validators), 64)
+
+def get_folder_size(path):
+    """returns summed size of all files below path in bytes"""
+    size = 0
+    for root, _, files in os.walk(path):
+        for filename in files:
+            try:
+                size += os.lstat(os.path.join(root, filename)).st_size
+            except OSError:
+                pass
+    return size
+
+# ioctl to share the extents of a file, see ioctl_ficlone(2)
+FICLONE = 0x40049409
+
+def copy_file(src, dst):
+    """copy src to dst as reflink if the filesystem supports it, otherwise as
+    streamed copy synced to disk. returns the method used"""
+    with open(src, "rb") as src_file, open(dst, "wb") as dst_file:
+        try:
+            fcntl.ioctl(dst_file.fileno(), FICLONE, src_file.fileno())
+            method = "reflink"
+        except OSError:
+            shutil.copyfileobj(src_file, dst_file, 1024 * 1024)
+            dst_file.flush()
+            os.fsync(dst_file.fileno())
+            method = "copy"
+    shutil.copystat(src, dst)
+    return method
+
+def move_file(src, dst):
+    """move src to dst by rename, files on different filesystems (or btrfs
+    subvolumes) are copied. returns the method used"""
+    try:
+        os.rename(src, dst)
+        return "rename"
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+
+    if os.path.isdir(src):
+        shutil.copytree(src, dst, copy_function=copy_file)
+        shutil.rmtree(src)
+        return "copy"
+
+    method = copy_file(src, dst)
+    os.remove(src)
+    return method
+
 def usign_init(comment=None):
     keys_private = config.get_folder("keys_private")
     if not os.path.exists(keys_private + "/secret"):
@@ -1,53 +1,127 @@
+import threading
+import time
 import yaml
 import os.path
 import os
 from os import listdir, makedirs
 
+# use the C implementation of libyaml if available
+YamlLoader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+class ConfigFiles():
+    """Process wide cache of parsed YAML files and directory listings
+
+    Entries are reloaded once the mtime of the file changes. The mtime itself
+    is only checked every `check_interval` seconds, so hot paths don't even
+    cost a stat call.
+    """
+    check_interval = 1
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # path: [mtime, last check, content]
+        self.entries = {}
+
+    # returns load(path) of the current file content, None if it's missing
+    def get(self, path, load):
+        now = time.time()
+        entry = self.entries.get(path)
+        if entry and now - entry[1] < self.check_interval:
+            return entry[2]
+
+        with self.lock:
+            try:
+                mtime = os.stat(path).st_mtime_ns
+            except FileNotFoundError:
+                mtime = None
+            entry = self.entries.get(path)
+            if not entry or entry[0] != mtime:
+                entry = [mtime, now, load(path) if mtime is not None else None]
+                self.entries[path] = entry
+            entry[1] = now
+            return entry[2]
+
+    # returns the mtime of all cached files, used to validate results
+    # derived from several files
+    def mtimes(self, paths):
+        return tuple(self.entries[path][0] if path in self.entries else None
+                for path in paths)
+
+def load_yaml(path):
+    with open(path, "r") as ymlfile:
+        return yaml.load(ymlfile, Loader=YamlLoader)
+
+files = ConfigFiles()
+
 class Config():
+    """Shared configuration of server and worker
+
+    Creating a Config is cheap, all instances share the cached files. Changes
+    of config.yml or distribution files are picked up without restart.
+    """
+    # (distro, version): (paths, mtimes, version config)
+    versions = {}
+
     def __init__(self):
-        self.config = {}
         self.config_file = "config.yml"
 
         if not os.path.exists(self.config_file):
             print("Missing config.yml")
             exit(1)
 
-        with open(self.config_file, 'r') as ymlfile:
-            self.config = yaml.load(ymlfile)
+    @property
+    def config(self):
+        return files.get(self.config_file, load_yaml)
 
-        for distro in self.get_distros():
-            with open(os.path.join(self.get_folder("distro_folder"), distro, "distro_config.yml"), 'r') as ymlfile:
-                self.config[distro] = yaml.load(ymlfile)
+    def distro_file(self, distro, filename):
+        return os.path.join(self.config.get("distro_folder"), distro, filename)
 
     # load configuration of distro and overlay it with custom version settings
     def version(self, distro, version):
+        cached = self.versions.get((distro, version))
+        if cached:
+            paths, mtimes, version_config = cached
+            for path in paths:
+                files.get(path, load_yaml)
+            if files.mtimes(paths) == mtimes:
+                return dict(version_config)
+
+        # files the overlay depends on, including the ones of parents
+        paths = []
+        version_config = self.resolve_version(distro, version, paths)
+        self.versions[(distro, version)] = (paths, files.mtimes(paths), version_config)
+        return dict(version_config)
+
+    def resolve_version(self, distro, version, paths):
         version_config = {}
-        base_path = self.get_folder("distro_folder") + "/" + distro
+        distro_path = self.distro_file(distro, "distro_config.yml")
+        version_path = self.distro_file(distro, version + ".yml")
+        paths.extend([distro_path, version_path])
 
-        with open(base_path + "/distro_config.yml", 'r') as distro_file:
-            version_config.update(yaml.load(distro_file.read()))
+        version_config.update(files.get(distro_path, load_yaml) or {})
 
-        version_path = os.path.join(base_path, version + ".yml")
-        if os.path.exists(version_path):
-            with open(version_path, 'r') as version_file:
-                version_content = yaml.load(version_file.read())
-                if version_content:
-                    version_config.update(version_content)
+        version_content = files.get(version_path, load_yaml)
+        if version_content:
+            version_config.update(version_content)
 
         # if distro is based on another distro, load these settings as well
         if "parent_version" in version_config:
-            parent_config = self.version(
+            parent_config = self.resolve_version(
                     version_config["parent_distro"],
-                    version_config["parent_version"])
+                    version_config["parent_version"], paths)
 
             parent_config.update(version_config)
             return parent_config
 
         return version_config
 
+    # distribution names return their distro_config.yml
     def get(self, opt, alt=None):
-        if opt in self.config:
-            return self.config[opt]
+        if opt in self.get_distros():
+            return files.get(self.distro_file(opt, "distro_config.yml"), load_yaml)
+        config = self.config
+        if opt in config:
+            return config[opt]
         return alt
 
     def get_folder(self, requested_folder):
@@ -57,9 +131,9 @@ class Config():
             return os.path.abspath(folder)
 
         # if unset use $PWD/<requested_folder>
-        default_folder = os.path.join(os.getcwdb(), requested_folder)
+        default_folder = os.path.join(os.getcwd(), requested_folder)
         if not os.path.exists(default_folder): makedirs(default_folder)
         return os.path.abspath(default_folder)
 
     def get_distros(self):
-        return(listdir(self.config.get("distro_folder")))
+        return files.get(self.config.get("distro_folder"), listdir)
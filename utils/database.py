@@ -1,40 +1,193 @@
 import datetime
 from re import sub
+from contextlib import contextmanager
+from queue import LifoQueue, Empty
+import threading
+import select
+import time
 import pyodbc
 import logging
 import json
 
+# only required to receive notifications, see Listener
+try:
+    import psycopg2
+except ImportError:
+    psycopg2 = None
+
 from utils.common import get_hash
 
+class ConnectionPool():
+    """Bounded, process wide pool of database connections
+
+    Connections are created lazily up to `size`, checked for health before
+    they're handed out again and shared between all Database objects using
+    the same connection string.
+    """
+    pools = {}
+    pools_lock = threading.Lock()
+
+    # get the pool for the configured database, create it on first use
+    @classmethod
+    def get_pool(cls, config):
+        connection_string = "DRIVER={};SERVER={};DATABASE={};UID={};PWD={};PORT={};BoolsAsChar=0".format(
+                config.get("database_type"),
+                config.get("database_address"),
+                config.get("database_name"),
+                config.get("database_user"),
+                config.get("database_pass"),
+                config.get("database_port"))
+        with cls.pools_lock:
+            if connection_string not in cls.pools:
+                cls.pools[connection_string] = cls(connection_string,
+                        config.get("database_pool_size", 10),
+                        config.get("database_pool_timeout", 30))
+            return cls.pools[connection_string]
+
+    def __init__(self, connection_string, size=10, timeout=30, check_interval=30):
+        self.log = logging.getLogger(__name__)
+        self.connection_string = connection_string
+        self.timeout = timeout
+        self.check_interval = check_interval
+        self.slots = threading.BoundedSemaphore(size)
+        # lifo keeps the number of actually used connections low
+        self.idle = LifoQueue()
+
+    def connect(self):
+        self.log.info("open database connection")
+        return pyodbc.connect(self.connection_string)
+
+    # connections idle for a while are pinged before reuse
+    def healthy(self, cnxn, last_used):
+        if time.time() - last_used < self.check_interval:
+            return True
+        try:
+            cnxn.cursor().execute("select 1").fetchall()
+            return True
+        except pyodbc.Error:
+            self.log.warning("drop broken database connection")
+            return False
+
+    def checkout(self):
+        if not self.slots.acquire(timeout=self.timeout):
+            raise RuntimeError("no database connection available")
+        try:
+            while True:
+                try:
+                    cnxn, last_used = self.idle.get_nowait()
+                except Empty:
+                    return self.connect()
+                if self.healthy(cnxn, last_used):
+                    return cnxn
+                self.close(cnxn)
+        except:
+            self.slots.release()
+            raise
+
+    def checkin(self, cnxn, broken=False):
+        if broken:
+            self.close(cnxn)
+        else:
+            self.idle.put((cnxn, time.time()))
+        self.slots.release()
+
+    def close(self, cnxn):
+        try:
+            cnxn.close()
+        except pyodbc.Error:
+            pass
+
+class Listener():
+    """Wait for notifications sent via pg_notify on a channel
+
+    ODBC doesn't deliver notifications, so a dedicated psycopg2 connection is
+    used. Without psycopg2 installed wait() sleeps for the whole timeout,
+    which degrades to polling.
+    """
+    def __init__(self, config, channel):
+        self.log = logging.getLogger(__name__)
+        self.config = config
+        self.channel = channel
+        self.cnxn = None
+        if psycopg2:
+            self.connect()
+        else:
+            self.log.warning("psycopg2 not installed, poll instead of listen on %s", channel)
+
+    def connect(self):
+        try:
+            self.cnxn = psycopg2.connect(
+                    host=self.config.get("database_address"),
+                    port=self.config.get("database_port"),
+                    dbname=self.config.get("database_name"),
+                    user=self.config.get("database_user"),
+                    password=self.config.get("database_pass"))
+            self.cnxn.autocommit = True
+            self.cnxn.cursor().execute("LISTEN " + self.channel)
+            self.log.info("listen on %s", self.channel)
+        except psycopg2.Error:
+            self.log.warning("could not listen on %s", self.channel)
+            self.cnxn = None
+
+    # returns payloads of notifications received within timeout seconds
+    def wait(self, timeout):
+        if not self.cnxn:
+            time.sleep(timeout)
+            if psycopg2:
+                self.connect()
+            return []
+
+        try:
+            if not self.cnxn.notifies:
+                select.select([self.cnxn], [], [], timeout)
+            self.cnxn.poll()
+        except (psycopg2.Error, OSError):
+            self.log.warning("lost connection listening on %s", self.channel)
+            self.cnxn = None
+            return []
+
+        payloads = [notify.payload for notify in self.cnxn.notifies]
+        self.cnxn.notifies.clear()
+        return payloads
+
 class Database():
     def __init__(self, config):
         self.log = logging.getLogger(__name__)
         self.log.info("log initialized")
         self.config = config
         self.log.info("config initialized")
-        connection_string = "DRIVER={};SERVER={};DATABASE={};UID={};PWD={};PORT={};BoolsAsChar=0".format(
-                self.config.get("database_type"),
-                self.config.get("database_address"),
-                self.config.get("database_name"),
-                self.config.get("database_user"),
-                self.config.get("database_pass"),
-                self.config.get("database_port"))
-        self.cnxn = pyodbc.connect(connection_string)
-        self.c = self.cnxn.cursor()
-        self.log.info("database connected")
-
-    def commit(self):
-        self.cnxn.commit()
+        self.pool = ConnectionPool.get_pool(self.config)
+        self.log.info("database pool attached")
+
+    # borrow a connection from the pool for a single transaction. it's
+    # committed if the block succeeds and rolled back otherwise
+    @contextmanager
+    def cursor(self):
+        cnxn = self.pool.checkout()
+        broken = False
+        try:
+            c = cnxn.cursor()
+            yield c
+            cnxn.commit()
+        except:
+            try:
+                cnxn.rollback()
+            except pyodbc.Error:
+                broken = True
+            raise
+        finally:
+            self.pool.checkin(cnxn, broken)
 
     def insert_defaults(self, defaults_hash, defaults):
         sql = "insert into defaults_table (hash, content) values (?, ?) on conflict do nothing"
-        self.c.execute(sql, defaults_hash, defaults)
-        self.commit()
+        with self.cursor() as c:
+            c.execute(sql, defaults_hash, defaults)
 
     def get_defaults(self, defaults_hash):
         sql = "select content from defaults_table where hash = ?"
-        self.c.execute(sql, defaults_hash)
-        return self.c.fetchval()
+        with self.cursor() as c:
+            c.execute(sql, defaults_hash)
+            return c.fetchval()
 
     def insert_distro(self, distro):
         self.log.info("insert distro %s", distro)
@@ -46,18 +199,19 @@ class Database():
 
     def insert_supported(self, p):
         sql = """UPDATE subtargets SET supported = true WHERE distro=? and version=? and target=? and subtarget=?"""
-        self.c.execute(sql, p["distro"], p["version"], p["target"], p["subtarget"])
-        self.commit()
+        with self.cursor() as c:
+            c.execute(sql, p["distro"], p["version"], p["target"], p["subtarget"])
 
     def get_versions(self, distro=None):
-        if not distro:
-            return self.c.execute("select distro, version from versions").fetchall()
-        else:
-            versions = self.c.execute("select version from versions WHERE distro=?", (distro, )).fetchall()
-            respond = []
-            for version in versions:
-                respond.append(version[0])
-            return respond
+        with self.cursor() as c:
+            if not distro:
+                return c.execute("select distro, version from versions").fetchall()
+            else:
+                versions = c.execute("select version from versions WHERE distro=?", (distro, )).fetchall()
+                respond = []
+                for version in versions:
+                    respond.append(version[0])
+                return respond
 
     # TODO this should be done via some postgres json magic
     # currently this is splitted back and forth but I'm hungry
@@ -67,32 +221,6 @@ class Database():
             "packages": " ".join(sorted(packages, reverse=True))
         })
 
-    def insert_profiles(self, params, packages_default, profiles):
-        self.log.debug("insert packages_default")
-
-        # delete existing packages_default
-        sql = """delete from packages_default where
-            distro = ? and version = ? and target = ? and subtarget = ?"""
-        self.c.execute(sql, params["distro"], params["version"],
-            params["target"], params["subtarget"])
-
-        self.commit()
-
-        self.insert_dict("packages_default", { **params, "packages": packages_default})
-
-        # delete existing packages_profile
-        sql = """delete from packages_profile where
-            distro = ? and version = ? and target = ? and subtarget = ?"""
-        self.c.execute(sql, params["distro"], params["version"],
-            params["target"], params["subtarget"])
-        self.commit()
-        for profile in profiles:
-            profile, model, packages = profile
-            self.insert_dict("packages_profile",
-                    { **params, "profile": profile, "model": model,
-                        "packages": packages }, False)
-        self.commit()
-
     def check_packages(self, image):
         sql = """select value as packages_unknown
             from json_array_elements_text(?) as pr
@@ -105,68 +233,127 @@ class Database():
                     pa.package_name = pr)"""
         # the re.sub() replaces leading - which may appear in package request to
         # explicitly remove packages installed per default
-        self.c.execute(sql, json.dumps([sub(r'^-?', '', p) for p in image["packages"]]),
-                image["distro"], image["version"], image["target"], image["subtarget"])
-        return self.c.fetchone()
+        with self.cursor() as c:
+            c.execute(sql, json.dumps([sub(r'^-?', '', p) for p in image["packages"]]),
+                    image["distro"], image["version"], image["target"], image["subtarget"])
+            return [package[0] for package in c.fetchall()]
 
     def sysupgrade_supported(self, image):
-        self.c.execute("""SELECT supported from subtargets WHERE distro=? and version=? and target=? and subtarget = ? LIMIT 1;""",
-            image["distro"], image["version"], image["target"], image["subtarget"])
-        return self.c.fetchval()
+        with self.cursor() as c:
+            c.execute("""SELECT supported from subtargets WHERE distro=? and version=? and target=? and subtarget = ? LIMIT 1;""",
+                image["distro"], image["version"], image["target"], image["subtarget"])
+            return c.fetchval()
 
     def check_profile(self, distro, version, target, subtarget, profile):
         self.log.debug("check_profile %s/%s/%s/%s/%s", distro, version, target, subtarget, profile)
-        self.c.execute("""SELECT profile FROM profiles
-            WHERE distro=? and version=? and target=? and subtarget = ? and profile = coalesce(
-                (select newname from board_rename where distro = ? and version = ? and target = ? and subtarget = ? and origname = ?), ?)
-            LIMIT 1;""",
-            distro, version, target, subtarget, distro, version, target, subtarget, profile, profile)
-        return self.c.fetchval()
+        with self.cursor() as c:
+            c.execute("""SELECT profile FROM profiles
+                WHERE distro=? and version=? and target=? and subtarget = ? and profile = coalesce(
+                    (select newname from board_rename where distro = ? and version = ? and target = ? and subtarget = ? and origname = ?), ?)
+                LIMIT 1;""",
+                distro, version, target, subtarget, distro, version, target, subtarget, profile, profile)
+            return c.fetchval()
+
+    def get_profiles(self, distro, version, target, subtarget):
+        sql = """select profile, model from profiles
+            where distro = ? and version = ? and target = ? and subtarget = ?"""
+        with self.cursor() as c:
+            return c.execute(sql, distro, version, target, subtarget).fetchall()
+
+    def get_board_renames(self, distro, version):
+        sql = "select origname, newname from board_rename where distro = ? and version = ?"
+        with self.cursor() as c:
+            return c.execute(sql, distro, version).fetchall()
 
     def check_model(self, distro, version, target, subtarget, model):
         self.log.debug("check_model %s/%s/%s/%s/%s", distro, version, target, subtarget, model)
-        self.c.execute("""SELECT profile FROM profiles
-            WHERE distro=? and version=? and target=? and subtarget = ? and lower(model) = lower(?);""",
-            distro, version, target, subtarget, model)
-        return self.c.fetchval()
+        with self.cursor() as c:
+            c.execute("""SELECT profile FROM profiles
+                WHERE distro=? and version=? and target=? and subtarget = ? and lower(model) = lower(?);""",
+                distro, version, target, subtarget, model)
+            return c.fetchval()
 
     def get_image_packages(self, distro, version, target, subtarget, profile, as_json=False):
         self.log.debug("get_image_packages for %s/%s/%s/%s/%s", distro, version, target, subtarget, profile)
         sql = "select packages from packages_image where distro = ? and version = ? and target = ? and subtarget = ? and profile = ?"
-        self.c.execute(sql, distro, version, target, subtarget, profile)
-        return json.dumps({"packages": self.c.fetchval().rstrip().split(" ")})
+        with self.cursor() as c:
+            c.execute(sql, distro, version, target, subtarget, profile)
+            return json.dumps({"packages": c.fetchval().rstrip().split(" ")})
 
     # removes an image entry based on image_hash
-    def del_image(self, image_hash):
-        sql = """delete from images where image_hash = ?;"""
-        self.c.execute(sql, image_hash)
-        self.commit()
+    def del_images(self, image_hashes):
+        sql = """delete from images_table where image_hash in
+            (select json_array_elements_text(?::json));"""
+        with self.cursor() as c:
+            c.execute(sql, json.dumps(image_hashes))
 
     # removes all snapshot requests older than a day
     def del_outdated_request(self,):
         sql = """delete from image_requests where
             snapshots = 'true' and
             request_date < NOW() - interval '1 day'"""
-        self.c.execute(sql)
-        self.commit()
+        with self.cursor() as c:
+            c.execute(sql)
 
     def get_outdated_manifests(self):
-        sql = """select image_hash, file_path from images join images_download using (image_hash)
-            join manifest_upgrades using (distro, version, target, subtarget, manifest_hash);"""
-        self.c.execute(sql)
-        return self.c.fetchall()
+        sql = """select image_hash, file_path, images_download.size from images_table
+            join images_download using (image_hash)
+            join profiles_table on profiles_table.id = images_table.profile_id
+            join manifest_upgrades_table mu on
+                mu.subtarget_id = profiles_table.subtarget_id and
+                mu.manifest_id = images_table.manifest_id;"""
+        with self.cursor() as c:
+            c.execute(sql)
+            return c.fetchall()
 
     def get_outdated_snapshots(self):
-        sql = """select image_hash, file_path from images join images_download using (image_hash)
+        sql = """select image_hash, file_path, images.size from images join images_download using (image_hash)
             where snapshots = 'true' and build_date < NOW() - INTERVAL '1 day';"""
-        self.c.execute(sql)
-        return self.c.fetchall()
+        with self.cursor() as c:
+            c.execute(sql)
+            return c.fetchall()
 
     def get_outdated_customs(self):
-        sql = """select image_hash, file_path from images join images_download using (image_hash)
+        sql = """select image_hash, file_path, images.size from images join images_download using (image_hash)
             where defaults_hash != '' and build_date < NOW() - INTERVAL '7 day';"""
-        self.c.execute(sql)
-        return self.c.fetchall()
+        with self.cursor() as c:
+            c.execute(sql)
+            return c.fetchall()
+
+    # returns the least recently downloaded images, never downloaded images
+    # count from their build date
+    def get_images_lru(self, count):
+        sql = """select image_hash, file_path, images_download.size from images_table
+            join images_download using (image_hash)
+            order by coalesce(last_download, build_date)
+            limit ?;"""
+        with self.cursor() as c:
+            c.execute(sql, count)
+            return c.fetchall()
+
+    # images stored before their size was recorded
+    def get_images_unmeasured(self, count):
+        sql = "select image_hash, file_path from images_download where size is null limit ?;"
+        with self.cursor() as c:
+            c.execute(sql, count)
+            return c.fetchall()
+
+    def set_image_sizes(self, sizes):
+        sql = """update images_table set size = (s->>1)::bigint
+            from json_array_elements(?::json) s
+            where images_table.image_hash = s->>0;"""
+        with self.cursor() as c:
+            c.execute(sql, json.dumps(sizes))
+
+    def get_images_size(self):
+        sql = "select coalesce(sum(size), 0) from images_table;"
+        with self.cursor() as c:
+            return int(c.execute(sql).fetchval())
+
+    def add_image_downloads(self, counts):
+        sql = "select add_image_downloads(?::json)"
+        with self.cursor() as c:
+            c.execute(sql, json.dumps([[file_path, downloads] for file_path, downloads in counts.items()]))
 
     def manifest_outdated(self, p):
         sql = """select upgrades
@@ -177,51 +364,97 @@ class Database():
                     version = ? and
                     target = ? and
                     subtarget = ?;"""
-        self.c.execute(sql, p["manifest_hash"], p["distro"], p["version"], p["target"], p["subtarget"])
-        return self.c.fetchval()
-
-    def get_subtarget_outdated(self):
-        sql = """UPDATE subtargets
-            SET last_sync = NOW()
-            where id = (select id  from subtargets
-            where last_sync < NOW() - INTERVAL '1 day'
-            order by (last_sync) asc limit 1)
-            returning distro, version, target, subtarget;"""
-        self.c.execute(sql)
-        self.commit()
-        return self.as_dict()
-
-    # todo this should be improved somehow
-    # currently the insert takes quite long as there are ~6000 packages
-    def insert_packages_available(self, params, packages):
-        self.log.debug("insert packages available")
-        for package in packages:
-            name, version = package
-            self.insert_dict("packages_available",
-                { **params, "package_name": name, "package_version": version }, False)
-        self.commit()
+        with self.cursor() as c:
+            c.execute(sql, p["manifest_hash"], p["distro"], p["version"], p["target"], p["subtarget"])
+            return c.fetchval()
+
+    # calculate upgrades of a (new) manifest for the requested subtarget
+    def insert_manifest_upgrades(self, p):
+        sql = "select add_manifest_upgrades(?, ?, ?, ?, ?)"
+        with self.cursor() as c:
+            c.execute(sql, p["distro"], p["version"], p["target"], p["subtarget"], p["manifest_hash"])
+
+    # claim up to count subtargets not checked within interval seconds, ranked
+    # by pending build requests and upgrade checks of the last week. subtargets
+    # with pending requests are already outdated after hot_interval seconds.
+    # last_check is set when claiming, last_sync only changes with the data
+    def get_subtargets_outdated(self, count=1, interval=86400, hot_interval=3600):
+        sql = """with claimed as (
+                UPDATE subtargets_table
+                SET last_check = NOW()
+                where id in (select st.id from subtargets_table st
+                    left join image_requests_subtargets irs on irs.subtarget_id = st.id
+                    left join (select subtarget_id, sum(checks) as checks
+                        from upgrade_check_stats group by subtarget_id) ucs
+                        on ucs.subtarget_id = st.id
+                    where st.last_check < NOW() - ? * interval '1 second' or (
+                        irs.requests > 0 and st.last_check < NOW() - ? * interval '1 second')
+                    order by coalesce(irs.requests, 0) desc,
+                        coalesce(ucs.checks, 0) desc,
+                        st.last_check asc
+                    limit ?
+                    for update of st skip locked)
+                returning id
+            )
+            select distro, version, target, subtarget, fingerprint
+            from subtargets join claimed using (id);"""
+        with self.cursor() as c:
+            c.execute(sql, interval, hot_interval, count)
+            return self.as_dicts(c)
+
+    # counts maps (distro, version, target, subtarget) to upgrade checks
+    def add_upgrade_check_stats(self, counts):
+        sql = "select add_upgrade_check_stats(?::json)"
+        with self.cursor() as c:
+            c.execute(sql, json.dumps([[*subtarget, checks] for subtarget, checks in counts.items()]))
+
+    # apply the result of an Updater run as diff, returns True if anything
+    # changed. the fingerprint is stored to skip unchanged subtargets
+    def sync_subtarget(self, params, default_packages, profiles, packages, fingerprint):
+        self.log.debug("sync %d profiles and %d packages", len(profiles), len(packages))
+        sql = "select sync_subtarget(?, ?, ?, ?, ?, ?::json, ?::json, ?)"
+        with self.cursor() as c:
+            c.execute(sql, params["distro"], params["version"],
+                params["target"], params["subtarget"], default_packages,
+                json.dumps([list(profile) for profile in profiles]),
+                json.dumps([[name, version] for name, version in packages]),
+                fingerprint)
+            return c.fetchval()
 
     def get_packages_available(self, distro, version, target, subtarget):
         self.log.debug("get_available_packages for %s/%s/%s/%s", distro, version, target, subtarget)
-        self.c.execute("""SELECT name, version
-            FROM packages_available
-            WHERE distro=? and version=? and target=? and subtarget=?;""",
-            distro, version, target, subtarget)
-        response = {}
-        for name, version in self.c.fetchall():
-            response[name] = version
-        return response
+        with self.cursor() as c:
+            c.execute("""SELECT package_name, package_version
+                FROM packages_available
+                WHERE distro=? and version=? and target=? and subtarget=?;""",
+                distro, version, target, subtarget)
+            response = {}
+            for name, version in c.fetchall():
+                response[name] = version
+            return response
 
-    def insert_subtarget(self, distro, version, target, subtarget):
-        sql = "INSERT INTO subtargets (distro, version, target, subtarget) VALUES (?, ?, ?, ?);"
-        self.c.execute(sql, distro, version, target, subtarget)
-        self.commit()
+    # insert all subtargets of a version within a single transaction
+    def insert_subtargets(self, distro, version, subtargets):
+        sql = """insert into subtargets_table (version_id, target, subtarget)
+            select versions.id, s->>0, s->>1
+            from versions, json_array_elements(?::json) as s
+            where versions.distro = ? and versions.version = ?
+            on conflict do nothing;"""
+        with self.cursor() as c:
+            c.execute(sql, json.dumps(subtargets), distro, version)
+
+    # used by server side caches to detect synced subtargets
+    def get_subtargets_sync(self):
+        sql = "select distro, version, target, subtarget, supported, last_sync from subtargets"
+        with self.cursor() as c:
+            return c.execute(sql).fetchall()
 
     def get_subtargets(self, distro, version, target="%", subtarget="%"):
         self.log.debug("get_subtargets {} {} {} {}".format(distro, version, target, subtarget))
-        return self.c.execute("""SELECT target, subtarget, supported FROM subtargets
-            WHERE distro = ? and version = ? and target LIKE ? and subtarget LIKE ?;""",
-            distro, version, target, subtarget).fetchall()
+        with self.cursor() as c:
+            return c.execute("""SELECT target, subtarget, supported FROM subtargets
+                WHERE distro = ? and version = ? and target LIKE ? and subtarget LIKE ?;""",
+                distro, version, target, subtarget).fetchall()
 
     # check for image_hash or request_hash depending on length
     # TODO make it less confusing
@@ -232,62 +465,111 @@ class Database():
         else:
             self.log.debug("check_build_request_hash image_hash")
             sql = "select * from image_requests where image_hash = ?"
-        self.c.execute(sql, request_hash)
-        return self.as_dict()
+        with self.cursor() as c:
+            c.execute(sql, request_hash)
+            return self.as_dict(c)
 
     # returns upgrade requests responses cached in database
     def check_upgrade_check_hash(self, check_hash):
         self.log.debug("check_upgrade_hash")
         sql = "select * from upgrade_checks where check_hash = ?"
-        self.c.execute(sql, check_hash)
-        return self.as_dict()
+        with self.cursor() as c:
+            c.execute(sql, check_hash)
+            return self.as_dict(c)
+
+    # returns { check_hash: upgrade check } of all known check hashes
+    def check_upgrade_check_hashes(self, check_hashes):
+        sql = """select * from upgrade_checks where check_hash in
+            (select json_array_elements_text(?::json))"""
+        with self.cursor() as c:
+            c.execute(sql, json.dumps(check_hashes))
+            return { row["check_hash"]: row for row in self.as_dicts(c) }
 
     def insert_upgrade_check(self, p):
         sql = """insert into upgrade_checks (check_hash, distro, version, target, subtarget, manifest_hash) values (?, ?, ?, ?, ?, ?);"""
-        self.c.execute(sql, p["check_hash"], p["distro"], p["version"], p["target"], p["subtarget"], p["manifest_hash"])
-        self.commit()
+        with self.cursor() as c:
+            c.execute(sql, p["check_hash"], p["distro"], p["version"], p["target"], p["subtarget"], p["manifest_hash"])
 
     # inserts an image to the build queue
     def add_build_job(self, image):
         self.log.info("add build job %s", image)
         self.insert_dict("image_requests", image)
 
+    # status only, without the joins of the image_requests view
+    def get_build_request_status(self, request_hash):
+        sql = "select status from image_requests_table where request_hash = ?"
+        with self.cursor() as c:
+            c.execute(sql, request_hash)
+            return c.fetchval()
+
+    # returns { request_hash: image request } of all known request hashes
+    def get_build_requests(self, request_hashes):
+        sql = """select * from image_requests where request_hash in
+            (select json_array_elements_text(?::json))"""
+        with self.cursor() as c:
+            c.execute(sql, json.dumps(request_hashes))
+            return { row["request_hash"]: row for row in self.as_dicts(c) }
+
+    # inserts many images to the build queue using one statement for the
+    # packages hashes and one for the requests
+    def add_build_jobs(self, images):
+        self.log.info("add %d build jobs", len(images))
+        packages_hashes = { image["packages_hash"]: " ".join(sorted(image["packages"], reverse=True))
+                for image in images }
+        with self.cursor() as c:
+            c.execute("""select add_packages_hashes(p->>0, p->>1)
+                from json_array_elements(?::json) p""",
+                json.dumps(list(packages_hashes.items())))
+            c.execute("""insert into image_requests
+                (request_hash, distro, version, target, subtarget, profile, packages_hash)
+                select r->>0, r->>1, r->>2, r->>3, r->>4, r->>5, r->>6
+                from json_array_elements(?::json) r""",
+                json.dumps([[image["request_hash"], image["distro"], image["version"],
+                    image["target"], image["subtarget"], image["profile"],
+                    image["packages_hash"]] for image in images]))
+
     def check_build_request(self, request):
         request_array = request.as_array()
         request_hash = get_hash(" ".join(request_array), 12)
         self.log.debug("check_request")
         sql = "select image_hash, id, request_hash, status from image_requests where request_hash = ?"
-        self.c.execute(sql, request_hash)
-        if self.c.rowcount == 1:
-            return self.c.fetchone()
-        else:
-            self.log.debug("add build job")
-            sql = """INSERT INTO image_requests
-                (request_hash, distro, version, target, subtarget, profile, packages_hash)
-                VALUES (?, ?, ?, ?, ?, ?, ?)"""
-            self.c.execute(sql, request_hash, *request_array)
-            self.commit()
-            return('', 0, request_hash, 'requested')
+        with self.cursor() as c:
+            c.execute(sql, request_hash)
+            if c.rowcount == 1:
+                return c.fetchone()
+            else:
+                self.log.debug("add build job")
+                sql = """INSERT INTO image_requests
+                    (request_hash, distro, version, target, subtarget, profile, packages_hash)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)"""
+                c.execute(sql, request_hash, *request_array)
+                return('', 0, request_hash, 'requested')
 
     # merge image_download table with images tables
     def get_image_path(self, image_hash):
         self.log.debug("get sysupgrade image for %s", image_hash)
         sql = "select * from images_download where image_hash = ?"
-        self.c.execute(sql, image_hash)
-        return self.as_dict()
+        with self.cursor() as c:
+            c.execute(sql, image_hash)
+            return self.as_dict(c)
 
     # TODO check if there is a native way to do this
-    def as_dict(self):
-        if self.c.rowcount == 1:
-            response = dict(zip([column[0] for column in self.c.description], self.c.fetchone()))
+    def as_dict(self, c):
+        if c.rowcount == 1:
+            response = dict(zip([column[0] for column in c.description], c.fetchone()))
             self.log.debug(response)
             return response
         else:
             return {}
 
+    def as_dicts(self, c):
+        columns = [column[0] for column in c.description]
+        return [dict(zip(columns, row)) for row in c.fetchall()]
+
     # TODO check is this must be removed
     # this is dangerours if used for user input. check all everything before calling this
-    def insert_dict(self, table, data, commit=True):
+    # if a cursor is passed the insert becomes part of its transaction
+    def insert_dict(self, table, data, c=None):
         columns = []
         values = []
         for key, value in data.items():
@@ -295,44 +577,130 @@ class Database():
             values.append(value)
         sql = 'insert into {} ({}) values ({})'.format(
                 table, ', '.join(columns), "?" + ",?" * (len(values) - 1))
-        self.c.execute(sql, values)
-        if commit:
-            self.commit()
+        if c:
+            c.execute(sql, values)
+        else:
+            with self.cursor() as c:
+                c.execute(sql, values)
 
     def add_image(self, image):
         self.insert_dict("images", image)
 
+    # returns manifest_hash of a previous build with equal profile and packages
+    def get_manifest_cache(self, image):
+        sql = """select manifest_hash from manifest_cache where
+            distro = ? and version = ? and target = ? and subtarget = ? and
+            profile = ? and packages_hash = ?;"""
+        with self.cursor() as c:
+            c.execute(sql, image["distro"], image["version"], image["target"],
+                    image["subtarget"], image["profile"], image["packages_hash"])
+            return c.fetchval()
+
+    def insert_manifest_cache(self, image):
+        self.insert_dict("manifest_cache", {
+            "distro": image["distro"],
+            "version": image["version"],
+            "target": image["target"],
+            "subtarget": image["subtarget"],
+            "profile": image["profile"],
+            "packages_hash": image["packages_hash"],
+            "manifest_hash": image["manifest_hash"]
+            })
+
     def add_manifest_packages(self, manifest_hash, packages):
         self.log.debug("add manifest packages")
-        sql = """INSERT INTO manifest_table (hash) VALUES (?) ON CONFLICT DO NOTHING;"""
-        self.c.execute(sql, manifest_hash)
-        for name, version in packages.items():
-            sql = """INSERT INTO manifest_packages (manifest_hash, package_name, package_version) VALUES (?, ?, ?);"""
-            self.c.execute(sql, manifest_hash, name, version)
-        self.commit()
-
-    def get_build_job(self):
-        sql = """UPDATE image_requests
-            SET status = 'building'
-            FROM packages_hashes
-            WHERE image_requests.packages_hash = packages_hashes.hash and
-                image_requests.id = (
-                    SELECT MIN(id)
-                    FROM image_requests
-                    WHERE status = 'requested'
+        with self.cursor() as c:
+            sql = """INSERT INTO manifest_table (hash) VALUES (?) ON CONFLICT DO NOTHING;"""
+            c.execute(sql, manifest_hash)
+            for name, version in packages.items():
+                sql = """INSERT INTO manifest_packages (manifest_hash, package_name, package_version) VALUES (?, ?, ?);"""
+                c.execute(sql, manifest_hash, name, version)
+
+    # returns pending requests per subtarget and seconds the oldest one waits
+    def get_build_queue(self):
+        sql = """select distro, version, target, subtarget, requests,
+                extract(epoch from now() - oldest_request)
+            from image_requests_subtargets;"""
+        with self.cursor() as c:
+            c.execute(sql)
+            return c.fetchall()
+
+    # claim up to count queued requests of a subtarget for a worker, skip
+    # locked rows so multiple dispatchers never receive the same job. claimed
+    # jobs are leased for lease seconds, workers renew it via worker_heartbeat()
+    def get_build_jobs(self, distro, version, target, subtarget, count=1, lease=300, worker=None):
+        sql = """with claimed as (
+                UPDATE image_requests_table
+                SET status = 'building',
+                    lease_expires = now() + ? * interval '1 second',
+                    worker_id = (select id from worker where name = ?)
+                WHERE id in (
+                    SELECT image_requests_table.id
+                    FROM image_requests_table
+                    JOIN profiles_table ON profiles_table.id = image_requests_table.profile_id
+                    WHERE status = 'requested' and subtarget_id = (
+                        select id from subtargets where
+                            distro = ? and version = ? and target = ? and subtarget = ?)
+                    ORDER BY image_requests_table.id
+                    LIMIT ?
+                    FOR UPDATE OF image_requests_table SKIP LOCKED
                 )
-            RETURNING image_requests.id, request_hash, image_hash, distro, version, target, subtarget, profile, packages_hashes.packages, defaults_hash;"""
-        self.c.execute(sql)
-        self.commit()
-        return self.as_dict()
+                RETURNING id
+            )
+            SELECT image_requests.id, request_hash, image_hash, distro, version, target, subtarget, profile, packages_hash, packages_hashes.packages, defaults_hash
+            FROM image_requests
+            JOIN claimed USING (id)
+            JOIN packages_hashes ON image_requests.packages_hash = packages_hashes.hash
+            ORDER BY image_requests.id;"""
+        with self.cursor() as c:
+            c.execute(sql, lease, worker, distro, version, target, subtarget, count)
+            return self.as_dicts(c)
+
+    # requeue requests of workers which stopped sending heartbeats
+    def requeue_expired_leases(self):
+        sql = """UPDATE image_requests_table SET
+                status = 'requested',
+                worker_id = null,
+                lease_expires = null
+            WHERE status = 'building' and lease_expires < now()
+            RETURNING request_hash;"""
+        with self.cursor() as c:
+            c.execute(sql)
+            return [request[0] for request in c.fetchall()]
+
+    def worker_heartbeat(self, name, request_hash, lease):
+        sql = "select worker_heartbeat(?, ?, ?)"
+        with self.cursor() as c:
+            c.execute(sql, name, request_hash, lease)
+
+    # jobs which only waited for another build are not counted
+    def worker_job_done(self, name, built=True):
+        sql = "UPDATE worker SET jobs_done = jobs_done + ?, busy = false WHERE name = ?"
+        with self.cursor() as c:
+            c.execute(sql, int(built), name)
+
+    def get_worker_utilization(self):
+        sql = """select coalesce(json_agg(worker_utilization), '[]') from
+            (select * from worker_utilization order by name) as worker_utilization;"""
+        with self.cursor() as c:
+            c.execute(sql)
+            return c.fetchval()
 
     def set_image_requests_status(self, image_request_hash, status):
         self.log.info("set image {} status to {}".format(image_request_hash, status))
         sql = """UPDATE image_requests
             SET status = ?
             WHERE request_hash = ?;"""
-        self.c.execute(sql, status, image_request_hash)
-        self.commit()
+        with self.cursor() as c:
+            c.execute(sql, status, image_request_hash)
+
+    # returns False if another request already builds the image, the request
+    # then receives the result of that build
+    def start_image_build(self, image_hash, request_hash):
+        sql = "select start_image_build(?, ?)"
+        with self.cursor() as c:
+            c.execute(sql, image_hash, request_hash)
+            return c.fetchval()
 
     def done_build_job(self, request_hash, image_hash, status="created"):
         self.log.info("done build job: rqst %s img %s status %s", request_hash, image_hash, status)
@@ -340,14 +708,14 @@ class Database():
             status = ?,
             image_hash = ?
             WHERE request_hash = ?;"""
-        self.c.execute(sql, status, image_hash, request_hash)
-        self.commit()
+        with self.cursor() as c:
+            c.execute(sql, status, image_hash, request_hash)
 
     def reset_build_requests(self):
         self.log.debug("reset building images")
         sql = "UPDATE image_requests SET status = 'requested' WHERE status = 'building'"
-        self.c.execute(sql)
-        self.commit()
+        with self.cursor() as c:
+            c.execute(sql)
 
     def get_subtargets_supported(self):
         self.log.debug("get subtargets supported")
@@ -358,43 +726,49 @@ class Database():
                 group by (distro, version, target)
                 order by distro, version desc, target"""
 
-        self.c.execute(sql)
-        result = self.c.fetchall()
-        return result
+        with self.cursor() as c:
+            c.execute(sql)
+            result = c.fetchall()
+            return result
 
     def api_get_distros(self):
         sql = """select coalesce(array_to_json(array_agg(row_to_json(distributions))), '[]')
                 from (select * from distributions order by (alias)) as distributions;"""
-        return self.c.execute(sql).fetchval()
+        with self.cursor() as c:
+            return c.execute(sql).fetchval()
 
     def api_get_versions(self):
 #        sql = """select json_build_object(distro, json_agg(versions)) from versions group by (distro);"""
         sql = """select coalesce(array_to_json(array_agg(row_to_json(versions))), '[]')
                 from (select * from versions order by (alias)) as versions;"""
-        return self.c.execute(sql).fetchval()
+        with self.cursor() as c:
+            return c.execute(sql).fetchval()
 
     def get_supported_models(self, search='', distro='', version=''):
         search_like = '%' + search.lower() + '%'
         if distro == '': distro = '%'
         if version == '': version = '%'
 
-        sql = """select coalesce(array_to_json(array_agg(row_to_json(profiles))), '[]') from profiles where lower(model) LIKE ? and distro LIKE ? and version LIKE ?;"""
-        response = self.c.execute(sql, search_like, distro, version).fetchval()
-        if response == "[]":
-            sql = """select coalesce(array_to_json(array_agg(row_to_json(profiles))), '[]') from profiles where (lower(target) LIKE ? or lower(subtarget) LIKE ? or lower(profile) LIKE ?)and distro LIKE ? and version LIKE ?;"""
-            response = self.c.execute(sql, search_like, search_like, search_like, distro, version).fetchval()
+        with self.cursor() as c:
+            sql = """select coalesce(array_to_json(array_agg(row_to_json(profiles))), '[]') from profiles where lower(model) LIKE ? and distro LIKE ? and version LIKE ?;"""
+            response = c.execute(sql, search_like, distro, version).fetchval()
+            if response == "[]":
+                sql = """select coalesce(array_to_json(array_agg(row_to_json(profiles))), '[]') from profiles where (lower(target) LIKE ? or lower(subtarget) LIKE ? or lower(profile) LIKE ?)and distro LIKE ? and version LIKE ?;"""
+                response = c.execute(sql, search_like, search_like, search_like, distro, version).fetchval()
 
         return response
 
     def get_subtargets_json(self, distro='%', version='%', target='%'):
         sql = """select coalesce(array_to_json(array_agg(row_to_json(subtargets))), '[]') from subtargets where distro like ? and version like ? and target like ?;"""
-        self.c.execute(sql, distro, version, target)
-        return self.c.fetchval()
+        with self.cursor() as c:
+            c.execute(sql, distro, version, target)
+            return c.fetchval()
 
     def get_image_info(self, image_hash):
         self.log.debug("get image info %s", image_hash)
         sql = "select row_to_json(images) from images where image_hash = ?"
-        return self.c.execute(sql, image_hash).fetchval()
+        with self.cursor() as c:
+            return c.execute(sql, image_hash).fetchval()
 
     def get_manifest_info(self, manifest_hash, json=False):
         self.log.debug("get manifest info %s", manifest_hash)
@@ -402,27 +776,31 @@ class Database():
             manifest_packages.package_name,
             manifest_packages.package_version
             ) from manifest_packages where manifest_hash = ?;"""
-        self.c.execute(sql, manifest_hash)
-        return self.c.fetchval()
+        with self.cursor() as c:
+            c.execute(sql, manifest_hash)
+            return c.fetchval()
 
     def get_packages_hash(self, packages_hash):
         self.log.debug("get packages_hash %s", packages_hash)
         sql = "select package_name from packages_hashes where hash = ?;"
-        return self.c.execute(sql, packages_hash).fetchval()
+        with self.cursor() as c:
+            return c.execute(sql, packages_hash).fetchval()
 
     def get_popular_targets(self):
         sql = """select json_agg(popular_targets) from (
                 select
                     count(*) as count,
                     avg(build_seconds)::integer as build_seconds,
+                    avg(build_jobs)::integer as build_jobs,
                     target, subtarget
                 from images
                 group by (target, subtarget)
                 order by count desc
                 limit 50
             ) as popular_targets;"""
-        self.c.execute(sql)
-        return self.c.fetchval()
+        with self.cursor() as c:
+            c.execute(sql)
+            return c.fetchval()
 
     def get_image_stats(self):
         self.log.debug("get image stats")
@@ -430,59 +808,66 @@ class Database():
                 (select last_value as total from image_requests_table_id_seq) as total,
                 (select count(*) as stored from images) as stored,
                 (select count(*) as requested from image_requests where status = 'requested') as requested) as image_stats;"""
-        self.c.execute(sql)
-        return self.c.fetchval()
+        with self.cursor() as c:
+            c.execute(sql)
+            return c.fetchval()
 
-    def get_all_profiles(self):
+    def get_all_profiles(self, distro, version):
         sql = """select target, subtarget, profile from profiles where distro =
-        'openwrt' and version = '18.06.1' and profile != 'Default';"""
-        self.c.execute(sql)
-        return self.c.fetchall()
+        ? and version = ? and profile != 'Default';"""
+        with self.cursor() as c:
+            c.execute(sql, distro, version)
+            return c.fetchall()
 
     # get latest 20 images created
     def get_images_latest(self):
         sql = """select json_agg(images_latest) from (select * from images
         where defaults_hash is null order by id desc limit 20) as
         images_latest;"""
-        self.c.execute(sql)
-        return self.c.fetchval()
+        with self.cursor() as c:
+            c.execute(sql)
+            return c.fetchval()
 
     def get_fails_latest(self):
         sql = """select json_agg(fails_latest) from (select * from
         image_requests where status != 'created' and status != 'requested' and
         status != 'building' and status != 'no_sysupgrade' and defaults_hash is
         null order by id desc limit 50) as fails_latest;"""
-        self.c.execute(sql)
-        return self.c.fetchval()
+        with self.cursor() as c:
+            c.execute(sql)
+            return c.fetchval()
 
     def get_packages_count(self):
         self.log.debug("get packages count")
         sql = "select count(*) as count from packages_names;"
-        self.c.execute(sql)
-        return self.c.fetchval()
+        with self.cursor() as c:
+            c.execute(sql)
+            return c.fetchval()
 
     def insert_board_rename(self, distro, version, origname, newname):
         sql = "INSERT INTO board_rename (distro, version, origname, newname) VALUES (?, ?, ?, ?);"
-        self.c.execute(sql, distro, version, origname, newname)
-        self.commit()
+        with self.cursor() as c:
+            c.execute(sql, distro, version, origname, newname)
 
     def insert_transformation(self, distro, version, package, replacement, context):
         self.log.info("insert %s/%s ", distro, version)
         sql = "INSERT INTO transformations (distro, version, package, replacement, context) VALUES (?, ?, ?, ?, ?);"
-        self.c.execute(sql, distro, version, package, replacement, context)
-        self.commit()
+        with self.cursor() as c:
+            c.execute(sql, distro, version, package, replacement, context)
 
     # TODO broken
     def transform_packages(self, distro, orig_version, dest_version, packages):
         self.log.debug("transform packages {} {} {} {}".format(distro, orig_version, dest_version, packages))
         sql = "select transform(?, ?, ?, ?)"
-        self.c.execute(sql, distro, orig_version, dest_version, packages)
-        return self.c.fetchall()
+        with self.cursor() as c:
+            c.execute(sql, distro, orig_version, dest_version, packages)
+            return c.fetchall()
 
     def get_popular_packages(self):
         sql = """select json_agg(popular_packages) from (select package_name,
         count(package_name) as count from packages_hashes_link phl join
         packages_names pn on phl.package_id = pn.id group by package_name order
         by count desc limit 50) as popular_packages;"""
-        self.c.execute(sql)
-        return self.c.fetchval()
+        with self.cursor() as c:
+            c.execute(sql)
+            return c.fetchval()
@@ -3,15 +3,12 @@ import os.path
 
 from utils.common import get_hash
 from utils.config import Config
-from utils.database import Database
 
 class Image():
     def __init__(self, params):
         self.config = Config()
         self.log = logging.getLogger(__name__)
         self.log.info("config initialized")
-        self.database = Database(self.config)
-        self.log.info("database initialized")
         self.params = params
 
         if not "defaults_hash" in self.params:
@@ -84,6 +81,9 @@ class Image():
             "defaults_hash": self.params["defaults_hash"],
             "worker": self.params["worker"],
             "build_seconds": self.params["build_seconds"],
+            "build_jobs": self.params["build_jobs"],
+            "size": self.params.get("size"),
+            "publish_seconds": self.params.get("publish_seconds", 0),
             "sysupgrade": self.params["sysupgrade"]
         }
 
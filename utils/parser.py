@@ -0,0 +1,156 @@
+import glob
+import gzip
+import os
+import re
+import tarfile
+
+# line oriented parsers of the meta ImageBuilder output. all of them read
+# lines one by one and keep no more than the current profile in memory, so
+# they work directly on the output streamed by MetaProcess
+
+# returns default packages and a list of (profile, model, packages)
+#
+# Default Packages: base-files busybox ...
+# Available Profiles:
+#
+# tl-wdr4300-v1:
+#     TP-LINK TL-WDR4300 v1
+#     Packages: kmod-usb-core ...
+def parse_info(lines):
+    default_packages = None
+    profiles = []
+    profile = model = None
+    for line in lines:
+        line = line.rstrip("\n")
+        if line.startswith("Default Packages: "):
+            default_packages = line[len("Default Packages: "):]
+        elif model is not None and line.startswith("    Packages: "):
+            profiles.append((profile, model, line[len("    Packages: "):]))
+            profile = model = None
+        elif profile is not None and model is None and line.startswith("    ") and line[4:]:
+            model = line[4:]
+        elif line.endswith(":") and len(line) > 1:
+            profile, model = line[:-1], None
+        else:
+            profile = model = None
+    return default_packages, profiles
+
+# yields (name, version) of "name - version - description" lines
+def parse_package_list(lines):
+    for line in lines:
+        package = line.rstrip("\n").split(" - ", 2)
+        if len(package) == 3 and package[0] and package[1]:
+            yield package[0], package[1]
+
+# yields (name, version) of "name - version" lines
+def parse_manifest(lines):
+    for line in lines:
+        name, _, version = line.rstrip("\n").rpartition(" - ")
+        if name and version:
+            yield name, version
+
+# yields (name, version, size) of the paragraphs of an opkg Packages index
+#
+# Package: busybox
+# Version: 1.28.4-3
+# Size: 218421
+def parse_packages(lines):
+    name = version = size = None
+    for line in lines:
+        # most lines are other fields, compare their first letter only
+        first = line[:1]
+        if first == "P" and line.startswith("Package: "):
+            name = line[len("Package: "):].strip()
+        elif first == "V" and line.startswith("Version: "):
+            version = line[len("Version: "):].strip()
+        elif first == "S" and line.startswith("Size: "):
+            size = int(line[len("Size: "):])
+        elif first in "\n\r " and not line.strip():
+            if name and version:
+                yield name, version, size
+            name = version = size = None
+    if name and version:
+        yield name, version, size
+
+# yields (name, version, size) of an opkg Packages or Packages.gz index
+def parse_packages_index(path):
+    with open(path, "rb") as index_file:
+        compressed = index_file.read(2) == b"\x1f\x8b"
+    if compressed:
+        index_file = gzip.open(path, "rt", encoding="utf-8", errors="replace")
+    else:
+        index_file = open(path, "r", encoding="utf-8", errors="replace")
+
+    with index_file:
+        yield from parse_packages(index_file)
+
+# returns (name, version, size) of the control file within an ipk
+def parse_ipk(path):
+    with tarfile.open(path) as ipk:
+        control = ipk.extractfile(next(member for member in ipk.getmembers()
+            if os.path.basename(member.name) == "control.tar.gz"))
+        with tarfile.open(fileobj=control) as control_tar:
+            control_file = control_tar.extractfile(next(member for member in
+                control_tar.getmembers() if os.path.basename(member.name) == "control"))
+            lines = control_file.read().decode("utf-8", "replace").splitlines(True)
+    return next(parse_packages(lines), None)
+
+# yields (name, version, size) of a local package folder. uses its index if
+# existing, the ImageBuilder creates it only on its first build
+def parse_packages_folder(path):
+    for index in ["Packages.gz", "Packages"]:
+        if os.path.exists(os.path.join(path, index)):
+            yield from parse_packages_index(os.path.join(path, index))
+            return
+
+    for ipk in sorted(glob.glob(os.path.join(path, "*.ipk"))):
+        package = parse_ipk(ipk)
+        if package:
+            yield package
+
+if __name__ == "__main__":
+    import io
+    import sys
+    import time
+
+    # compare with the regular expressions used before
+    def benchmark(name, old, new, content):
+        start = time.time()
+        old_result = old(content)
+        old_time = time.time() - start
+        start = time.time()
+        new_result = new(io.StringIO(content))
+        new_time = time.time() - start
+        print("{:<28} regex {:8.4f}s  parser {:8.4f}s  {}".format(
+            name, old_time, new_time, "equal" if old_result == new_result else "DIFFERENT"))
+
+    def old_info(output):
+        default_packages = re.match(r"(.*\n)*Default Packages: (.+)\n", output, re.M)
+        profiles = re.findall(r"(.+):\n    (.+)\n    Packages: (.*)\n", output)
+        return default_packages and default_packages.group(2), profiles
+
+    info = "Current Target: \"ar71xx (Generic)\"\nDefault Packages: base-files busybox\nAvailable Profiles:\n\n"
+    for i in range(5000):
+        info += "profile-{0}:\n    Model {0}\n    Packages: kmod-{0} -ppp\n    SupportedDevices: d-{0}\n".format(i)
+
+    package_list = "".join("package-{0} - 1.{0}-1 - Description of package {0}\n".format(i) for i in range(50000))
+    manifest = "".join("package-{0} - 1.{0}-1\n".format(i) for i in range(5000))
+    index = "".join("Package: package-{0}\nVersion: 1.{0}-1\nDepends: libc\nSize: {0}\n\n".format(i) for i in range(50000))
+
+    benchmark("info", old_info, parse_info, info)
+    benchmark("info long line", old_info, parse_info, "x" * 20000 + "\nDefault Packages: a\n")
+    benchmark("package_list",
+            lambda output: re.findall(r"(.+?) - (.+?) - .*\n", output),
+            lambda lines: list(parse_package_list(lines)), package_list)
+    # the Updater reads the indexes instead of the opkg list output
+    benchmark("package_list / Packages",
+            lambda output: re.findall(r"(.+?) - (.+?) - .*\n", package_list),
+            lambda lines: [(name, version) for name, version, _ in parse_packages(lines)], index)
+    benchmark("manifest",
+            lambda output: dict(re.findall(r"(.+) - (.+)\n", output)),
+            lambda lines: dict(parse_manifest(lines)), manifest)
+
+    for path in sys.argv[1:]:
+        start = time.time()
+        count = sum(1 for _ in parse_packages_index(path))
+        print("{:<28} {} packages in {:.4f}s".format(path, count, time.time() - start))
@@ -5,9 +5,17 @@ create table if not exists worker (
     name varchar(100),
     address varchar(100),
     public_key varchar(100),
+    busy boolean default false,
+    last_heartbeat timestamp,
+    jobs_done integer default 0,
     unique(name)
 );
 
+-- columns added later, tables.sql is also applied to existing databases
+alter table worker add column if not exists busy boolean default false;
+alter table worker add column if not exists last_heartbeat timestamp;
+alter table worker add column if not exists jobs_done integer default 0;
+
 create table if not exists distributions_table (
     id serial primary key,
     name varchar(20) not null,
@@ -80,9 +88,15 @@ create table if not exists subtargets_table(
     subtarget varchar(20),
     supported boolean DEFAULT false,
     last_sync timestamp default date('1970-01-01'),
+    last_check timestamp default date('1970-01-01'),
+    fingerprint varchar(64),
     unique(version_id, target, subtarget)
 );
 
+-- columns added later, tables.sql is also applied to existing databases
+alter table subtargets_table add column if not exists last_check timestamp default date('1970-01-01');
+alter table subtargets_table add column if not exists fingerprint varchar(64);
+
 create or replace view subtargets as
 select
     subtargets_table.id,
@@ -92,7 +106,9 @@ select
     target,
     subtarget,
     supported,
-    last_sync
+    last_sync,
+    last_check,
+    fingerprint
 from versions join subtargets_table on versions.id = subtargets_table.version_id;
 
 create or replace function add_subtargets(distro varchar, version varchar, target varchar, subtarget varchar) returns void as
@@ -260,6 +276,71 @@ SELECT add_packages_available(
     NEW.package_version
 );
 
+-- bulk variant of add_packages_available, packages is a json array of
+-- [name, version] pairs. the list is copied into a staging table at once and
+-- merged via set based statements instead of three upserts per package.
+-- packages missing in the list are removed, returns the number of changes
+drop function if exists add_packages_available_bulk(varchar, varchar, varchar, varchar, json);
+create or replace function add_packages_available_bulk(distro varchar(20), version varchar(20), target varchar(20), subtarget varchar(20), packages json) returns integer as
+$$
+declare
+sub_id integer = (select id from subtargets where
+    subtargets.distro = add_packages_available_bulk.distro and
+    subtargets.version = add_packages_available_bulk.version and
+    subtargets.target = add_packages_available_bulk.target and
+    subtargets.subtarget = add_packages_available_bulk.subtarget);
+changed integer;
+removed integer;
+begin
+    create temporary table if not exists packages_available_staging (
+        package_name varchar(100),
+        package_version varchar(100)
+    ) on commit drop;
+    truncate packages_available_staging;
+
+    insert into packages_available_staging (package_name, package_version)
+    select distinct on (p->>0) p->>0, p->>1
+    from json_array_elements(add_packages_available_bulk.packages) as p;
+
+    insert into packages_names (package_name)
+    select package_name from packages_available_staging
+    on conflict do nothing;
+
+    insert into packages_versions (package_version)
+    select distinct package_version from packages_available_staging
+    on conflict do nothing;
+
+    insert into packages_available_table (subtarget_id, package_id, version_id)
+    select sub_id, pn.id, pv.id
+    from packages_available_staging pas
+    join packages_names pn on pn.package_name = pas.package_name
+    join packages_versions pv on pv.package_version = pas.package_version
+    on conflict (subtarget_id, package_id) do update
+    set version_id = excluded.version_id
+    where packages_available_table.version_id != excluded.version_id;
+
+    get diagnostics changed = row_count;
+
+    delete from packages_available_table pat
+    where subtarget_id = sub_id and not exists (
+        select 1 from packages_available_staging pas
+        join packages_names pn on pn.package_name = pas.package_name
+        where pn.id = pat.package_id);
+    get diagnostics removed = row_count;
+    changed = changed + removed;
+
+    -- changed packages change the manifests the ImageBuilder resolves
+    if changed > 0 then
+        delete from manifest_cache_table where profile_id in (
+            select id from profiles_table where subtarget_id = sub_id);
+
+        -- mark packages as synced, this invalidates server side caches
+        update subtargets_table set last_sync = now() where id = sub_id;
+    end if;
+    return changed;
+end
+$$ language 'plpgsql';
+
 create table if not exists packages_default_table(
     subtarget_id integer references subtargets_table(id) ON DELETE CASCADE,
     package integer references packages_names(id) ON DELETE CASCADE,
@@ -491,6 +572,60 @@ SELECT add_packages_hashes(
     NEW.packages
 );
 
+-- manifest resolved by the ImageBuilder for requested packages of a profile,
+-- uci defaults only add files so they don't change the manifest
+create table if not exists manifest_cache_table (
+    profile_id integer references profiles_table(id) ON DELETE CASCADE,
+    packages_hash_id integer references packages_hashes_table(id) ON DELETE CASCADE,
+    manifest_id integer references manifest_table(id) ON DELETE CASCADE,
+    primary key(profile_id, packages_hash_id)
+);
+
+create or replace view manifest_cache as
+select
+    distro,
+    version,
+    target,
+    subtarget,
+    profile,
+    packages_hashes_table.hash as packages_hash,
+    manifest_table.hash as manifest_hash
+from manifest_cache_table
+join profiles on profiles.id = manifest_cache_table.profile_id
+join packages_hashes_table on packages_hashes_table.id = manifest_cache_table.packages_hash_id
+join manifest_table on manifest_table.id = manifest_cache_table.manifest_id;
+
+create or replace function add_manifest_cache(distro varchar, version varchar, target varchar, subtarget varchar, profile varchar, packages_hash varchar, manifest_hash varchar) returns void as
+$$
+begin
+    insert into manifest_cache_table (profile_id, packages_hash_id, manifest_id) values (
+        (select profiles.id from profiles where
+            profiles.distro = add_manifest_cache.distro and
+            profiles.version = add_manifest_cache.version and
+            profiles.target = add_manifest_cache.target and
+            profiles.subtarget = add_manifest_cache.subtarget and
+            profiles.profile = add_manifest_cache.profile),
+        (select id from packages_hashes_table where
+            packages_hashes_table.hash = add_manifest_cache.packages_hash),
+        (select id from manifest_table where
+            manifest_table.hash = add_manifest_cache.manifest_hash)
+    ) on conflict (profile_id, packages_hash_id) do update
+    set manifest_id = excluded.manifest_id;
+end
+$$ language 'plpgsql';
+
+create or replace rule insert_manifest_cache AS
+ON insert TO manifest_cache DO INSTEAD
+SELECT add_manifest_cache(
+    NEW.distro,
+    NEW.version,
+    NEW.target,
+    NEW.subtarget,
+    NEW.profile,
+    NEW.packages_hash,
+    NEW.manifest_hash
+);
+
 create or replace view packages_image as
 select distinct
 packages_default.distro,
@@ -527,9 +662,23 @@ create table if not exists images_table (
     status varchar(20) DEFAULT 'untested',
     defaults_id integer references defaults_table(id) on delete cascade,
     vanilla boolean default false,
-    build_seconds integer default 0
+    build_seconds integer default 0,
+    build_jobs integer default 0,
+    size bigint,
+    last_download timestamp,
+    downloads integer default 0,
+    publish_seconds real default 0
 );
 
+-- columns added later, tables.sql is also applied to existing databases
+alter table images_table add column if not exists build_jobs integer default 0;
+alter table images_table add column if not exists size bigint;
+alter table images_table add column if not exists last_download timestamp;
+alter table images_table add column if not exists downloads integer default 0;
+alter table images_table add column if not exists publish_seconds real default 0;
+
+create index if not exists images_table_last_download on images_table(coalesce(last_download, build_date));
+
 create or replace view images as
 select
     images_table.id,
@@ -548,7 +697,12 @@ select
     status,
     vanilla,
     build_seconds,
-    snapshots
+    snapshots,
+    build_jobs,
+    size,
+    last_download,
+    downloads,
+    publish_seconds
 from profiles,
     manifest_table,
     sysupgrade_files,
@@ -575,7 +729,10 @@ create or replace function add_image(
     sysupgrade varchar,
     build_date timestamp,
     vanilla boolean,
-    build_seconds decimal
+    build_seconds decimal,
+    build_jobs integer,
+    size bigint,
+    publish_seconds real
 )
 returns void as
 $$
@@ -590,7 +747,10 @@ begin
         worker_id,
         sysupgrade_id,
         vanilla,
-        build_seconds
+        build_seconds,
+        build_jobs,
+        size,
+        publish_seconds
     ) values (
         add_image.image_hash,
         (select profiles.id from profiles where
@@ -608,7 +768,10 @@ begin
         (select sysupgrade_files.id from sysupgrade_files where
             sysupgrade_files.sysupgrade = add_image.sysupgrade),
         add_image.vanilla,
-        add_image.build_seconds)
+        add_image.build_seconds,
+        add_image.build_jobs,
+        add_image.size,
+        add_image.publish_seconds)
     on conflict do nothing;
 end
 $$ language 'plpgsql';
@@ -628,7 +791,10 @@ SELECT add_image(
     NEW.sysupgrade,
     NEW.build_date,
     NEW.vanilla,
-    NEW.build_seconds
+    NEW.build_seconds,
+    NEW.build_jobs,
+    NEW.size,
+    NEW.publish_seconds
 );
 
 create or replace rule update_images AS
@@ -660,9 +826,25 @@ id, image_hash,
     || profile || '/'
     || manifest_hash || '/'
     as file_path,
-    sysupgrade
+    sysupgrade,
+    size
 from images;
 
+-- counts is a json list of [file_path, downloads] as collected by the server
+create or replace function add_image_downloads(counts json) returns void as
+$$
+begin
+    update images_table set
+        last_download = now(),
+        downloads = images_table.downloads + d.downloads
+    from (select images_download.id, sum((c->>1)::integer) as downloads
+        from json_array_elements(counts) c
+        join images_download on images_download.file_path = (c->>0) || '/'
+        group by images_download.id) d
+    where images_table.id = d.id;
+end
+$$ language 'plpgsql';
+
 create table if not exists image_requests_table (
     id SERIAL PRIMARY KEY,
     request_hash varchar(30) UNIQUE,
@@ -671,9 +853,15 @@ create table if not exists image_requests_table (
     defaults_id integer references defaults_table(id) on delete cascade,
     image_id integer references images_table(id) ON DELETE CASCADE,
     status varchar(20) DEFAULT 'requested',
-    request_date timestamp default now()
+    request_date timestamp default now(),
+    worker_id integer references worker(id) ON DELETE SET NULL,
+    lease_expires timestamp
 );
 
+-- columns added later, tables.sql is also applied to existing databases
+alter table image_requests_table add column if not exists worker_id integer references worker(id) ON DELETE SET NULL;
+alter table image_requests_table add column if not exists lease_expires timestamp;
+
 create or replace view image_requests as
 select
     image_requests_table.id,
@@ -738,11 +926,188 @@ on delete to image_requests do instead
 delete from image_requests_table
 where old.id = image_requests_table.id;
 
+create index if not exists image_requests_requested on image_requests_table(id) where status = 'requested';
+
+-- wake up build dispatchers listening on image_requests whenever a request
+-- is (re)queued
+create or replace function notify_image_requests() returns trigger as
+$$
+begin
+    perform pg_notify('image_requests', new.request_hash);
+    return new;
+end
+$$ language 'plpgsql';
+
+drop trigger if exists image_requests_notify on image_requests_table;
+create trigger image_requests_notify
+after insert or update of status on image_requests_table
+for each row when (new.status = 'requested')
+execute procedure notify_image_requests();
+
+-- push status changes to clients waiting on a request, see BuildStatusHub
+create or replace function notify_image_requests_status() returns trigger as
+$$
+begin
+    perform pg_notify('image_requests_status', new.request_hash || ' ' || new.status);
+    return new;
+end
+$$ language 'plpgsql';
+
+drop trigger if exists image_requests_status_notify on image_requests_table;
+create trigger image_requests_status_notify
+after update of status on image_requests_table
+for each row when (old.status is distinct from new.status)
+execute procedure notify_image_requests_status();
+
+create index if not exists image_requests_building on image_requests_table(lease_expires) where status = 'building';
+
+-- requests resolving to the same image are built once. the first request
+-- building an image_hash is the leader, later ones wait for its result
+create table if not exists image_builds_inflight (
+    image_hash varchar(30) primary key,
+    request_id integer references image_requests_table(id) ON DELETE CASCADE
+);
+
+create table if not exists image_builds_waiting (
+    image_hash varchar(30) references image_builds_inflight(image_hash) ON DELETE CASCADE,
+    request_id integer references image_requests_table(id) ON DELETE CASCADE,
+    primary key(image_hash, request_id)
+);
+
+-- returns true if the request should build the image, otherwise it waits
+-- for the leader and shares its lease. the inflight row is locked before
+-- waiters are added, so finish_image_build sees all of them
+create or replace function start_image_build(image_hash varchar, request_hash varchar) returns boolean as
+$$
+declare
+req_id integer = (select id from image_requests_table where
+    image_requests_table.request_hash = start_image_build.request_hash);
+leader_id integer;
+begin
+    loop
+        insert into image_builds_inflight (image_hash, request_id)
+        values (start_image_build.image_hash, req_id)
+        on conflict do nothing
+        returning request_id into leader_id;
+        if leader_id is not null then
+            return true;
+        end if;
+
+        select request_id into leader_id from image_builds_inflight where
+            image_builds_inflight.image_hash = start_image_build.image_hash
+        for update;
+        -- the leader finished meanwhile, try to lead
+        exit when found;
+    end loop;
+
+    -- take over if the leader stopped building without result
+    if leader_id = req_id or not exists (
+            select 1 from image_requests_table where
+                id = leader_id and status = 'building') then
+        update image_builds_inflight set request_id = req_id where
+            image_builds_inflight.image_hash = start_image_build.image_hash;
+        return true;
+    end if;
+
+    insert into image_builds_waiting (image_hash, request_id)
+    values (start_image_build.image_hash, req_id) on conflict do nothing;
+    -- the heartbeat of the leading worker renews the lease. without leader,
+    -- e.g. if it was deleted, the lease expires and the request is requeued
+    update image_requests_table set
+        worker_id = null,
+        lease_expires = leader.lease_expires
+    from image_requests_table leader
+    where leader.id = leader_id and image_requests_table.id = req_id;
+    return false;
+end
+$$ language 'plpgsql';
+
+-- once the leader leaves building, its waiters share the result. if the
+-- leader is requeued the waiters are requeued as well
+create or replace function finish_image_build() returns trigger as
+$$
+declare
+inflight_hash varchar;
+begin
+    select image_hash into inflight_hash from image_builds_inflight where
+        request_id = new.id
+    for update;
+    if inflight_hash is not null then
+        update image_requests_table set
+            status = new.status,
+            image_id = new.image_id,
+            lease_expires = null
+        where id in (select request_id from image_builds_waiting where image_hash = inflight_hash);
+        delete from image_builds_inflight where image_hash = inflight_hash;
+    end if;
+    return new;
+end
+$$ language 'plpgsql';
+
+drop trigger if exists image_requests_finish on image_requests_table;
+create trigger image_requests_finish
+after update of status on image_requests_table
+for each row when (old.status = 'building' and new.status != 'building')
+execute procedure finish_image_build();
+
+-- called periodically by workers, renews the lease of the request currently
+-- building. requests with expired leases are requeued by the dispatcher
+create or replace function worker_heartbeat(name varchar, request_hash varchar, lease integer) returns void as
+$$
+begin
+    insert into worker (name) values (worker_heartbeat.name) on conflict do nothing;
+    update worker set
+        last_heartbeat = now(),
+        busy = worker_heartbeat.request_hash is not null
+    where worker.name = worker_heartbeat.name;
+    -- renew the current job and all jobs batched to the worker
+    update image_requests_table set
+        lease_expires = now() + worker_heartbeat.lease * interval '1 second',
+        worker_id = (select id from worker where worker.name = worker_heartbeat.name)
+    where
+        (image_requests_table.request_hash = worker_heartbeat.request_hash or
+        image_requests_table.worker_id = (select id from worker where worker.name = worker_heartbeat.name)) and
+        status = 'building' and not exists (
+            select 1 from image_builds_waiting where
+                image_builds_waiting.request_id = image_requests_table.id);
+    -- and the requests waiting for images the worker builds
+    update image_requests_table set
+        lease_expires = now() + worker_heartbeat.lease * interval '1 second'
+    where status = 'building' and id in (
+        select image_builds_waiting.request_id from image_builds_waiting
+        join image_builds_inflight using (image_hash)
+        join image_requests_table leader on leader.id = image_builds_inflight.request_id
+        join worker on worker.id = leader.worker_id
+        where worker.name = worker_heartbeat.name and leader.status = 'building');
+end
+$$ language 'plpgsql';
+
+create or replace view worker_utilization as
+select
+    worker.name,
+    busy,
+    last_heartbeat,
+    jobs_done,
+    (select request_hash from image_requests_table where
+        image_requests_table.worker_id = worker.id and
+        status = 'building' limit 1) as request_hash
+from worker
+where last_heartbeat is not null;
+
 create or replace view image_requests_subtargets as
-select count(*) as requests, subtarget_id
-from image_requests_table, profiles_table
-where profiles_table.id = image_requests_table.profile_id and status = 'requested'
-group by (subtarget_id)
+select
+    count(*) as requests,
+    subtarget_id,
+    subtargets.distro,
+    subtargets.version,
+    subtargets.target,
+    subtargets.subtarget,
+    min(request_date) as oldest_request
+from image_requests_table
+join profiles_table on profiles_table.id = image_requests_table.profile_id
+join subtargets on subtargets.id = profiles_table.subtarget_id
+where status = 'requested'
+group by subtarget_id, subtargets.distro, subtargets.version, subtargets.target, subtargets.subtarget
 order by requests desc;
 
 CREATE TABLE IF NOT EXISTS board_rename_table (
@@ -878,7 +1243,20 @@ begin
 end
 $$ LANGUAGE 'plpgsql';
 
--- TODO check if this function is much to expensive
+-- upgrades of a manifest on a subtarget. this used to be a view joining every
+-- manifest against all available packages on each query, now rows are
+-- maintained via refresh_manifest_upgrades whenever packages of a subtarget
+-- are synced or a new manifest is checked. only manifests with outdated
+-- packages are stored
+create table if not exists manifest_upgrades_table (
+    subtarget_id integer references subtargets_table(id) ON DELETE CASCADE,
+    manifest_id integer references manifest_table(id) ON DELETE CASCADE,
+    upgrades json,
+    primary key(subtarget_id, manifest_id)
+);
+
+create index if not exists manifest_upgrades_manifest_id on manifest_upgrades_table(manifest_id);
+
 create or replace view manifest_upgrades as
 select
     distro,
@@ -886,20 +1264,165 @@ select
     target,
     subtarget,
     manifest_id,
-    manifest_hash,
-    json_object_agg(package_name,
-    package_versions) as upgrades
-    from (
-            select
-                    distro, version, target, subtarget,
-                    manifest_id, manifest_hash,
-                    pa.package_name as package_name,
-                    array[pa.package_version, mp.package_version] as package_versions
-            from manifest_packages mp join packages_available pa using (package_name)
-            where
-                    pa.package_version != mp.package_version
-    ) as upgrades group by (distro, version, target, subtarget, manifest_id, manifest_hash);
+    manifest_table.hash as manifest_hash,
+    upgrades
+from manifest_upgrades_table
+join subtargets on subtargets.id = manifest_upgrades_table.subtarget_id
+join manifest_table on manifest_table.id = manifest_upgrades_table.manifest_id;
 
+create or replace function refresh_manifest_upgrades(sub_id integer, manifest_ids integer[]) returns void as
+$$
+begin
+    delete from manifest_upgrades_table where
+        subtarget_id = sub_id and
+        manifest_id = any(manifest_ids);
+    insert into manifest_upgrades_table (subtarget_id, manifest_id, upgrades)
+    select sub_id, mpl.manifest_id, json_object_agg(pn.package_name,
+        array[pva.package_version, pvm.package_version])
+    from manifest_packages_link mpl
+    join packages_available_table pat on
+        pat.subtarget_id = sub_id and
+        pat.package_id = mpl.name_id
+    join packages_names pn on pn.id = mpl.name_id
+    join packages_versions pva on pva.id = pat.version_id
+    join packages_versions pvm on pvm.id = mpl.version_id
+    where
+        mpl.manifest_id = any(manifest_ids) and
+        pat.version_id != mpl.version_id
+    group by (mpl.manifest_id);
+end
+$$ language 'plpgsql';
+
+-- refresh all manifests known for a subtarget, called after a package sync
+create or replace function refresh_manifest_upgrades_subtarget(distro varchar, version varchar, target varchar, subtarget varchar) returns void as
+$$
+declare
+sub_id integer = (select id from subtargets where
+    subtargets.distro = refresh_manifest_upgrades_subtarget.distro and
+    subtargets.version = refresh_manifest_upgrades_subtarget.version and
+    subtargets.target = refresh_manifest_upgrades_subtarget.target and
+    subtargets.subtarget = refresh_manifest_upgrades_subtarget.subtarget);
+begin
+    perform refresh_manifest_upgrades(sub_id, array(
+        select manifest_id from upgrade_checks_table where
+            upgrade_checks_table.subtarget_id = sub_id
+        union
+        select images_table.manifest_id from images_table
+        join profiles_table on profiles_table.id = images_table.profile_id
+        where profiles_table.subtarget_id = sub_id
+        union
+        select manifest_id from manifest_upgrades_table where
+            manifest_upgrades_table.subtarget_id = sub_id));
+end
+$$ language 'plpgsql';
+
+-- apply a subtarget sync of the Updater in a single transaction. only added,
+-- removed and changed default packages, profile packages and available
+-- packages are written. profiles are never removed as images reference them.
+-- profiles_json is an array of [profile, model, packages], returns true if
+-- anything changed
+create or replace function sync_subtarget(distro varchar, version varchar, target varchar, subtarget varchar, default_packages text, profiles_json json, packages_json json, new_fingerprint varchar) returns boolean as
+$$
+declare
+sub_id integer = (select id from subtargets where
+    subtargets.distro = sync_subtarget.distro and
+    subtargets.version = sync_subtarget.version and
+    subtargets.target = sync_subtarget.target and
+    subtargets.subtarget = sync_subtarget.subtarget);
+default_array varchar[] = string_to_array(default_packages, ' ');
+changed integer = 0;
+links_changed integer = 0;
+packages_changed integer;
+rows integer;
+begin
+    insert into profiles_table (subtarget_id, profile, model)
+    select sub_id, p->>0, p->>1 from json_array_elements(profiles_json) as p
+    on conflict do nothing;
+    get diagnostics rows = row_count;
+    changed = changed + rows;
+
+    insert into packages_names (package_name)
+    select unnest(default_array)
+    union
+    select unnest(string_to_array(p->>2, ' ')) from json_array_elements(profiles_json) as p
+    on conflict do nothing;
+
+    delete from packages_default_table pdt
+    where subtarget_id = sub_id and not exists (
+        select 1 from packages_names pn where
+            pn.id = pdt.package and pn.package_name = any(default_array));
+    get diagnostics rows = row_count;
+    links_changed = links_changed + rows;
+
+    insert into packages_default_table (subtarget_id, package)
+    select sub_id, pn.id from packages_names pn where pn.package_name = any(default_array)
+    on conflict do nothing;
+    get diagnostics rows = row_count;
+    links_changed = links_changed + rows;
+
+    create temporary table if not exists packages_profile_staging (
+        profile_id integer,
+        package integer
+    ) on commit drop;
+    truncate packages_profile_staging;
+
+    insert into packages_profile_staging (profile_id, package)
+    select distinct pt.id, pn.id
+    from json_array_elements(profiles_json) as p
+    join profiles_table pt on
+        pt.subtarget_id = sub_id and pt.profile = p->>0 and pt.model = p->>1
+    join packages_names pn on pn.package_name = any(string_to_array(p->>2, ' '));
+
+    delete from packages_profile_table ppt
+    using profiles_table pt
+    where pt.id = ppt.profile_id and pt.subtarget_id = sub_id and not exists (
+        select 1 from packages_profile_staging pps where
+            pps.profile_id = ppt.profile_id and pps.package = ppt.package);
+    get diagnostics rows = row_count;
+    links_changed = links_changed + rows;
+
+    insert into packages_profile_table (profile_id, package)
+    select profile_id, package from packages_profile_staging
+    on conflict do nothing;
+    get diagnostics rows = row_count;
+    links_changed = links_changed + rows;
+
+    -- the ImageBuilder resolves other manifests for changed default packages
+    if links_changed > 0 then
+        delete from manifest_cache_table where profile_id in (
+            select id from profiles_table where subtarget_id = sub_id);
+    end if;
+    changed = changed + links_changed;
+
+    packages_changed = add_packages_available_bulk(distro, version, target, subtarget, packages_json);
+    if packages_changed > 0 then
+        perform refresh_manifest_upgrades_subtarget(distro, version, target, subtarget);
+    end if;
+    changed = changed + packages_changed;
+
+    -- let server side caches reload the subtarget
+    if changed > 0 then
+        update subtargets_table set last_sync = now() where id = sub_id;
+    end if;
+    update subtargets_table set fingerprint = new_fingerprint where id = sub_id;
+    return changed > 0;
+end
+$$ language 'plpgsql';
+
+-- calculate upgrades of a single manifest, called when a manifest is checked
+create or replace function add_manifest_upgrades(distro varchar, version varchar, target varchar, subtarget varchar, manifest_hash varchar) returns void as
+$$
+begin
+    perform refresh_manifest_upgrades(
+        (select id from subtargets where
+            subtargets.distro = add_manifest_upgrades.distro and
+            subtargets.version = add_manifest_upgrades.version and
+            subtargets.target = add_manifest_upgrades.target and
+            subtargets.subtarget = add_manifest_upgrades.subtarget),
+        array(select id from manifest_table where
+            manifest_table.hash = add_manifest_upgrades.manifest_hash));
+end
+$$ language 'plpgsql';
 
 create table if not exists upgrade_checks_table (
     id SERIAL PRIMARY KEY,
@@ -908,17 +1431,46 @@ create table if not exists upgrade_checks_table (
     manifest_id integer references manifest_table(id) ON DELETE CASCADE
 );
 
+create index if not exists upgrade_checks_subtarget_id on upgrade_checks_table(subtarget_id);
+
+-- upgrade checks per subtarget and day, used to sync busy subtargets first
+create table if not exists upgrade_check_stats (
+    subtarget_id integer references subtargets_table(id) ON DELETE CASCADE,
+    day date default current_date,
+    checks integer default 0,
+    primary key(subtarget_id, day)
+);
+
+-- counts is a json array of [distro, version, target, subtarget, checks],
+-- unknown subtargets are ignored. only the last week is kept
+create or replace function add_upgrade_check_stats(counts json) returns void as
+$$
+begin
+    insert into upgrade_check_stats (subtarget_id, day, checks)
+    select subtargets.id, current_date, sum((c->>4)::integer)
+    from json_array_elements(counts) as c
+    join subtargets on
+        subtargets.distro = c->>0 and
+        subtargets.version = c->>1 and
+        subtargets.target = c->>2 and
+        subtargets.subtarget = c->>3
+    group by subtargets.id
+    on conflict (subtarget_id, day) do update
+    set checks = upgrade_check_stats.checks + excluded.checks;
+
+    delete from upgrade_check_stats where day < current_date - 7;
+end
+$$ language 'plpgsql';
+
 create or replace view upgrade_checks as
 select
-uc.check_hash, s.distro, s.version, s.target, s.subtarget, manifest_hash, mu.upgrades
-from upgrade_checks_table uc, distributions d, subtargets s, manifest_upgrades mu where
-s.id = uc.subtarget_id and
-s.distro = d.name and
-mu.manifest_id = uc.manifest_id and
-mu.distro = s.distro and
-mu.version = s.version and
-mu.target = s.target and
-mu.subtarget = s.subtarget;
+uc.check_hash, s.distro, s.version, s.target, s.subtarget, mt.hash as manifest_hash, mu.upgrades
+from upgrade_checks_table uc
+join subtargets s on s.id = uc.subtarget_id
+join manifest_table mt on mt.id = uc.manifest_id
+join manifest_upgrades_table mu on
+    mu.subtarget_id = uc.subtarget_id and
+    mu.manifest_id = uc.manifest_id;
 
 create or replace rule insert_upgrade_checks AS
 ON insert TO upgrade_checks DO INSTEAD
@@ -1,59 +1,234 @@
 import threading
 import glob
-import re
-from queue import Queue
+import gzip
+from collections import Counter, deque
+from queue import Queue, Empty
 import shutil
 import tempfile
+import errno
 import os
 import os.path
 import subprocess
+import tarfile
+import urllib.error
+import urllib.request
 import logging
+import hashlib
 import time
 import pprint
 
 from utils.image import Image
-from utils.common import get_hash
+from utils.parser import parse_info, parse_manifest, parse_packages, parse_packages_folder
+from utils.common import get_hash, get_fingerprint, get_folder_size, move_file
+from utils.blobs import BlobStore
 from utils.config import Config
-from utils.database import Database
+from utils.database import Database, Listener
 
 class GarbageCollector(threading.Thread):
+    """Remove outdated images and keep the download folder below its quota
+
+    Once the quota is exceeded the least recently downloaded images are
+    removed in batches, deletions are throttled to not starve the workers and
+    the server of disk I/O. Files shared between images are stored in the
+    BlobStore and only removed once no image links them anymore.
+    """
     def __init__(self):
         threading.Thread.__init__(self)
         self.log = logging.getLogger(__name__)
         self.config = Config()
         self.database = Database(self.config)
-
-    def del_image(self, image):
-        image_hash, image_path = image
-        self.log.debug("remove outdated image %s", image)
-        self.database.del_image(image_hash)
-        if os.path.exists(image_path):
-            shutil.rmtree(image_path)
+        self.blobs = BlobStore(self.config)
+        self.download_folder = self.config.get_folder("download_folder")
+        self.quota = int((self.config.get("download_quota") or 0) * 1024 ** 3)
+        self.batch_size = self.config.get("gc_batch_size", 100)
+        self.delete_rate = self.config.get("gc_delete_rate", 50) * 1024 ** 2
+        # sweep blobs on the first run and whenever images were removed
+        self.removed = True
+
+    # files are removed before the database rows, an interrupted run leaves
+    # rows of missing images which are rebuild on request
+    def del_images(self, images):
+        if not images:
+            return 0
+        self.removed = True
+        freed = 0
+        for image_hash, file_path, size in images:
+            self.log.debug("remove image %s", image_hash)
+            image_path = os.path.join(self.download_folder, file_path)
+            if os.path.exists(image_path):
+                shutil.rmtree(image_path)
+            if size:
+                freed += size
+                if self.delete_rate:
+                    time.sleep(size / self.delete_rate)
+        self.database.del_images([image[0] for image in images])
+        return freed
+
+    # images created before their size was stored
+    def measure_images(self):
+        while True:
+            images = self.database.get_images_unmeasured(self.batch_size)
+            if not images:
+                break
+            self.database.set_image_sizes([[image_hash,
+                get_folder_size(os.path.join(self.download_folder, file_path))]
+                for image_hash, file_path in images])
+
+    def evict(self):
+        usage = self.database.get_images_size()
+        if usage <= self.quota:
+            return
+        self.log.info("download folder uses %d of %d bytes", usage, self.quota)
+        while usage > self.quota:
+            images = self.database.get_images_lru(self.batch_size)
+            if not images:
+                break
+            usage -= self.del_images(images)
+        self.log.info("download folder uses %d bytes after eviction", usage)
 
     def run(self):
+        last_rules = 0
         while True:
-            # remove outdated snapshot builds
-            for outdated_snapshot in self.database.get_outdated_snapshots():
-                self.del_image(outdated_snapshot)
+            # outdated images are removed every 6 hours
+            if time.time() - last_rules > 3600 * 6:
+                # remove outdated snapshot builds
+                self.del_images(self.database.get_outdated_snapshots())
+
+                # del custom images older than 7 days, without a quota these
+                # are not evicted otherwise
+                if not self.quota:
+                    self.del_images(self.database.get_outdated_customs())
+
+                # del oudated manifests
+                self.del_images(self.database.get_outdated_manifests())
+
+                # del outdated snapshot requests
+                self.database.del_outdated_request()
+                last_rules = time.time()
+
+            if self.quota:
+                self.measure_images()
+                self.evict()
 
-            # del custom images older than 7 days
-            for outdated_custom in self.database.get_outdated_customs():
-                self.del_image(outdated_custom)
+            if self.removed:
+                self.blobs.sweep()
+                self.removed = False
 
-            # del oudated manifests
-            for outdated_manifest in self.database.get_outdated_manifests():
-                self.del_image(outdated_manifest)
+            time.sleep(self.config.get("gc_interval", 300))
 
-            # del outdated snapshot requests
-            self.database.del_outdated_request()
+class Heartbeat(threading.Thread):
+    """Renew the lease of the job a worker is building
 
-            # run every 6 hours
-            time.sleep(3600 * 6)
+    The heartbeat stops with the worker thread, its job is then requeued by
+    the dispatcher once the lease expired.
+    """
+    def __init__(self, worker, lease):
+        threading.Thread.__init__(self, daemon=True)
+        self.log = logging.getLogger(__name__)
+        self.worker = worker
+        self.lease = lease
+
+    def run(self):
+        while self.worker.is_alive():
+            try:
+                self.worker.heartbeat()
+            except Exception:
+                self.log.exception("heartbeat of %s failed", self.worker.location)
+            time.sleep(self.lease / 3)
+
+class JobSlots():
+    """Share the cores of the host between concurrent builds
+
+    Each of the `builds` workers that may build at once gets an equal share
+    of the cores, so a build started first can't take the whole machine and
+    builds never wait for each other. If there are more workers than cores
+    each build still gets one slot.
+    """
+    def __init__(self, cores, builds=1):
+        self.cores = max(1, cores)
+        self.share = max(1, self.cores // max(1, builds))
+        self.free = self.cores
+        self.running = 0
+        self.lock = threading.Lock()
+
+    # returns the number of make jobs the build may run
+    def acquire(self):
+        with self.lock:
+            self.running += 1
+            jobs = max(1, min(self.free, self.share))
+            self.free -= jobs
+            return jobs
+
+    def release(self, jobs):
+        with self.lock:
+            self.free += jobs
+            self.running -= 1
+
+class MetaProcess():
+    """Run a meta command and stream its output
+
+    Lines of stdout are yielded as they arrive. stdout and stderr are
+    appended to the log file if given, only the last lines of stderr are
+    kept in memory.
+    """
+    def __init__(self, cmdline, cwd, env, log_path=None):
+        self.log = logging.getLogger(__name__)
+        self.log_file = None
+        if log_path:
+            self.log_file = open(log_path, "a", buffering=1)
+        self.log_lock = threading.Lock()
+        self.errors = deque(maxlen=50)
+        self.returncode = None
+        self.proc = subprocess.Popen(
+            cmdline,
+            cwd=cwd,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            shell=False,
+            env=env
+        )
+        self.stderr_reader = threading.Thread(target=self.read_stderr, daemon=True)
+        self.stderr_reader.start()
+        self.lines = self.read_stdout()
+
+    def write(self, line):
+        if self.log_file:
+            with self.log_lock:
+                self.log_file.write(line)
+
+    def read_stderr(self):
+        for line in self.proc.stderr:
+            line = line.decode("utf-8", "replace")
+            self.errors.append(line)
+            self.write(line)
+
+    def read_stdout(self):
+        for line in self.proc.stdout:
+            line = line.decode("utf-8", "replace")
+            self.write(line)
+            yield line
+
+    def __iter__(self):
+        return self.lines
+
+    # read remaining output and return the exit code
+    def wait(self):
+        for _ in self.lines:
+            pass
+        self.stderr_reader.join()
+        self.returncode = self.proc.wait()
+        if self.log_file:
+            self.log_file.close()
+        return self.returncode
 
 class Worker(threading.Thread):
-    def __init__(self, location, job, queue):
+    def __init__(self, location, job, queue, idle_queue=None, job_slots=None):
         self.location = location
         self.queue = queue
+        # if set the worker announces itself there whenever it's ready
+        self.idle_queue = idle_queue
+        # shared by all workers of the host, otherwise use all cores
+        self.job_slots = job_slots or JobSlots(os.cpu_count())
         self.job = job
         threading.Thread.__init__(self)
         self.log = logging.getLogger(__name__)
@@ -62,6 +237,26 @@ class Worker(threading.Thread):
         self.log.info("config initialized")
         self.database = Database(self.config)
         self.log.info("database initialized")
+        self.blobs = BlobStore(self.config)
+        self.tempdir = self.build_tempdir()
+        self.request_hash = None
+        # set by build() if the request waits for another build of its image
+        self.waiting = False
+        # subtargets dispatched to this worker, their ImageBuilder may still
+        # be in setup
+        self.subtargets = set()
+
+    def heartbeat(self):
+        self.database.worker_heartbeat(self.location, self.request_hash,
+                self.config.get("build_lease_seconds", 300))
+
+    # returns (distro, version, target, subtarget) of ImageBuilders ready to use
+    def warm_subtargets(self):
+        imagebuilder_dir = os.path.join(self.location, "imagebuilder")
+        warm = set(self.subtargets)
+        for path in glob.glob(os.path.join(imagebuilder_dir, "*", "*", "*", "*")):
+            warm.add(tuple(os.path.relpath(path, imagebuilder_dir).split(os.sep)))
+        return warm
 
     def setup_meta(self):
         self.log.debug("setup meta")
@@ -84,16 +279,69 @@ class Worker(threading.Thread):
 
         self.log.info("meta ImageBuilder successfully setup")
 
-    def write_log(self, path, stdout=None, stderr=None):
+    def write_log(self, path, cmd):
         with open(path, "a") as log_file:
+            if log_file.tell():
+                log_file.write("\n")
             log_file.write("### BUILD COMMAND:\n\n")
             for key, value in self.params.items():
                 log_file.write("{}={}\n".format(key.upper(), str(value)))
-            log_file.write("sh meta\n")
-            if stdout:
-                log_file.write("\n\n### STDOUT:\n\n" + stdout)
-            if stderr:
-                log_file.write("\n\n### STDERR:\n\n" + stderr)
+            log_file.write("sh meta {}\n\n### OUTPUT:\n\n".format(cmd))
+
+    # images are build next to the download folder, so they can be published
+    # by rename instead of being copied
+    def build_tempdir(self):
+        download_folder = self.config.get_folder("download_folder")
+        tempdir = os.path.join(download_folder, ".tmp")
+        if self.config.get("tempdir"):
+            configured = self.config.get_folder("tempdir")
+            if os.stat(configured).st_dev == os.stat(download_folder).st_dev:
+                return configured
+            self.log.warning("tempdir %s is not on the filesystem of %s, use %s",
+                    configured, download_folder, tempdir)
+        os.makedirs(tempdir, exist_ok=True)
+        return tempdir
+
+    # move build results into a staging folder which is renamed into place,
+    # so the image folder appears complete at once
+    def publish(self, build_dir):
+        publish_start = time.time()
+        image_dir = self.image.params["dir"]
+        staging_dir = tempfile.mkdtemp(prefix="publish-", dir=self.tempdir)
+        os.chmod(staging_dir, 0o755)
+
+        methods = Counter(move_file(os.path.join(build_dir, filename),
+            os.path.join(staging_dir, filename)) for filename in os.listdir(build_dir))
+        self.log.debug("published files by %s", dict(methods))
+
+        # link files equal to ones of other images, done before the build log
+        # is stored as it's unique anyway
+        self.blobs.add_folder(staging_dir)
+
+        os.makedirs(os.path.dirname(image_dir), exist_ok=True)
+        try:
+            os.rename(staging_dir, image_dir)
+        except OSError as e:
+            if e.errno not in (errno.ENOTEMPTY, errno.EEXIST):
+                raise
+            # an image with the same manifest was published already
+            for filename in os.listdir(staging_dir):
+                if os.path.exists(os.path.join(image_dir, filename)):
+                    self.log.warning("%s already exists in %s", filename, image_dir)
+                    continue
+                os.rename(os.path.join(staging_dir, filename), os.path.join(image_dir, filename))
+            shutil.rmtree(staging_dir)
+
+        self.image.params["publish_seconds"] = time.time() - publish_start
+
+    # move the streamed build log to its final location, drop it without
+    def store_log(self, build_log_path, path=None):
+        if os.path.exists(build_log_path):
+            if path:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                shutil.move(build_log_path, path)
+            else:
+                os.remove(build_log_path)
 
     # build image
     def build(self):
@@ -102,23 +350,41 @@ class Worker(threading.Thread):
         # fail path in case of erros
         fail_log_path = self.config.get_folder("download_folder") + "/faillogs/faillog-{}.txt".format(self.params["request_hash"])
 
-        self.image = Image(self.params)
-
-        # first determine the resulting manifest hash
-        return_code, manifest_content, errors = self.run_meta("manifest")
+        # output is streamed to the build log while running, it's moved to
+        # the success or fail path once the result is known
+        build_log_path = self.config.get_folder("download_folder") + "/running/buildlog-{}.txt".format(self.params["request_hash"])
+        os.makedirs(os.path.dirname(build_log_path), exist_ok=True)
 
-        if return_code == 0:
-            self.image.params["manifest_hash"] = get_hash(manifest_content, 15)
+        self.image = Image(self.params)
 
-            manifest_pattern = r"(.+) - (.+)\n"
-            manifest_packages = dict(re.findall(manifest_pattern, manifest_content))
-            self.database.add_manifest_packages(self.image.params["manifest_hash"], manifest_packages)
-            self.log.info("successfully parsed manifest")
+        # first determine the resulting manifest hash, reuse the manifest of a
+        # previous build with the same profile and packages if available
+        manifest_hash = self.database.get_manifest_cache(self.params)
+        if manifest_hash:
+            self.image.params["manifest_hash"] = manifest_hash
+            self.log.info("reuse manifest %s", manifest_hash)
         else:
-            self.log.error("couldn't determine manifest")
-            self.write_log(fail_log_path, stderr=errors)
-            self.database.set_image_requests_status(self.params["request_hash"], "manifest_fail")
-            return False
+            manifest = self.run_meta("manifest", build_log_path)
+            # hash equals get_hash() of the whole manifest
+            manifest_sha = hashlib.sha256()
+
+            def hash_lines(lines):
+                for line in lines:
+                    manifest_sha.update(bytes(line, 'utf-8'))
+                    yield line
+
+            manifest_packages = dict(parse_manifest(hash_lines(manifest)))
+
+            if manifest.wait() == 0:
+                self.image.params["manifest_hash"] = manifest_sha.hexdigest()[:15]
+                self.database.add_manifest_packages(self.image.params["manifest_hash"], manifest_packages)
+                self.database.insert_manifest_cache(self.image.params)
+                self.log.info("successfully parsed manifest")
+            else:
+                self.log.error("couldn't determine manifest")
+                self.store_log(build_log_path, fail_log_path)
+                self.database.set_image_requests_status(self.params["request_hash"], "manifest_fail")
+                return False
 
         # set directory where image is stored on server
         self.image.set_image_dir()
@@ -133,14 +399,20 @@ class Worker(threading.Thread):
         # set build_status ahead, if stuff goes wrong it will be changed
         self.build_status = "created"
 
+        # only one worker builds an image, duplicate requests wait for it
+        if not self.database.start_image_build(self.params["image_hash"], self.params["request_hash"]):
+            self.log.info("image %s is already building, wait for it", self.params["image_hash"])
+            self.store_log(build_log_path)
+            self.waiting = True
+            return True
+
         # check if image already exists
         if not self.image.created():
             self.log.info("build image")
-            with tempfile.TemporaryDirectory(dir=self.config.get_folder("tempdir")) as build_dir:
+            with tempfile.TemporaryDirectory(dir=self.tempdir) as build_dir:
                 # now actually build the image with manifest hash as EXTRA_IMAGE_NAME
                 self.params["worker"] = self.location
                 self.params["BIN_DIR"] = build_dir
-                self.params["j"] = str(os.cpu_count())
                 self.params["EXTRA_IMAGE_NAME"] = self.params["manifest_hash"]
                 # if uci defaults are added, at least at parts of the hash to time image name
                 if self.params["defaults_hash"]:
@@ -156,23 +428,28 @@ class Worker(threading.Thread):
                     self.params["FILES"] = build_dir + "/files/"
                     self.params["EXTRA_IMAGE_NAME"] += "-" + self.params["defaults_hash"][:6]
 
-                # download is already performed for manifest creation
-                self.params["NO_DOWNLOAD"] = "1"
-
-                build_start = time.time()
-                return_code, buildlog, errors = self.run_meta("image")
-                self.image.params["build_seconds"] = int(time.time() - build_start)
+                # download is already performed for manifest creation, a
+                # reused manifest skipped it
+                if not manifest_hash:
+                    self.params["NO_DOWNLOAD"] = "1"
+
+                self.params["build_jobs"] = self.job_slots.acquire()
+                self.params["j"] = str(self.params["build_jobs"])
+                try:
+                    build_start = time.time()
+                    too_big = False
+                    build = self.run_meta("image", build_log_path)
+                    for line in build:
+                        if "too big" in line:
+                            too_big = True
+                    return_code = build.wait()
+                    self.image.params["build_seconds"] = int(time.time() - build_start)
+                finally:
+                    self.job_slots.release(self.params["build_jobs"])
 
                 if return_code == 0:
-                    # create folder in advance
-                    os.makedirs(self.image.params["dir"], exist_ok=True)
-
                     self.log.debug(os.listdir(build_dir))
-
-                    for filename in os.listdir(build_dir):
-                        if os.path.exists(self.image.params["dir"] + "/" + filename):
-                            break
-                        shutil.move(build_dir + "/" + filename, self.image.params["dir"])
+                    self.publish(build_dir)
 
                     # possible sysupgrade names, ordered by likeliness
                     possible_sysupgrade_files = [ "*-squashfs-sysupgrade.bin",
@@ -190,10 +467,10 @@ class Worker(threading.Thread):
 
                     if not sysupgrade:
                         self.log.debug("sysupgrade not found")
-                        if buildlog.find("too big") != -1:
+                        if too_big or any("too big" in line for line in build.errors):
                             self.log.warning("created image was to big")
+                            self.store_log(build_log_path, fail_log_path)
                             self.database.set_image_requests_status(self.params["request_hash"], "imagesize_fail")
-                            self.write_log(fail_log_path, buildlog, errors)
                             return False
                         else:
                             self.build_status = "no_sysupgrade"
@@ -201,15 +478,19 @@ class Worker(threading.Thread):
                     else:
                         self.image.params["sysupgrade"] = os.path.basename(sysupgrade[0])
 
-                    self.write_log(success_log_path, buildlog)
+                    self.store_log(build_log_path, success_log_path)
+                    self.image.params["size"] = get_folder_size(self.image.params["dir"])
                     self.database.add_image(self.image.get_params())
                     self.log.info("build successfull")
                 else:
                     self.log.info("build failed")
+                    self.store_log(build_log_path, fail_log_path)
                     self.database.set_image_requests_status(self.params["request_hash"], 'build_fail')
-                    self.write_log(fail_log_path, buildlog, errors)
                     return False
 
+        # the existing image keeps the log of its build
+        self.store_log(build_log_path)
+
         self.log.info("link request %s to image %s", self.params["request_hash"], self.params["image_hash"])
         self.database.done_build_job(self.params["request_hash"], self.image.params["image_hash"], self.build_status)
         return True
@@ -217,28 +498,100 @@ class Worker(threading.Thread):
     def run(self):
         self.setup_meta()
 
+        if self.job == "image":
+            Heartbeat(self, self.config.get("build_lease_seconds", 300)).start()
+
         while True:
-            self.params = self.queue.get()
-            self.version_config = self.config.version(
-                    self.params["distro"], self.params["version"])
+            if self.idle_queue:
+                self.idle_queue.put(self)
             if self.job == "image":
-                self.build()
+                # image jobs arrive batched per subtarget
+                for self.params in self.queue.get():
+                    self.version_config = self.config.version(
+                            self.params["distro"], self.params["version"])
+                    # take over the lease right away
+                    self.request_hash = self.params["request_hash"]
+                    self.heartbeat()
+                    self.waiting = False
+                    self.build()
+                    self.request_hash = None
+                    self.database.worker_job_done(self.location, not self.waiting)
             elif self.job == "update":
-                self.info()
-                self.parse_packages()
-
-    def info(self):
-        self.parse_info()
-        if os.path.exists(os.path.join(
-                self.location, "imagebuilder",
-                self.params["distro"], self.params["version"],
-                self.params["target"], self.params["subtarget"],
+                self.params = self.queue.get()
+                self.version_config = self.config.version(
+                        self.params["distro"], self.params["version"])
+                self.update()
+
+    # sync profiles and packages of a subtarget if upstream changed
+    def update(self):
+        subtarget = "/".join([self.params["distro"], self.params["version"],
+            self.params["target"], self.params["subtarget"]])
+        fingerprint = self.upstream_fingerprint()
+        if fingerprint and fingerprint == self.params.get("fingerprint"):
+            self.log.info("%s is unchanged upstream", subtarget)
+            return
+
+        # sets up the ImageBuilder and its repositories.conf if missing
+        info = self.parse_info()
+        if not info:
+            return
+        packages = self.parse_packages()
+        if packages is None:
+            return
+
+        if os.path.exists(os.path.join(self.imagebuilder_dir(),
                 "target/linux", self.params["target"],
                 "base-files/lib/upgrade/platform.sh")):
             self.log.info("%s target is supported", self.params["target"])
             self.database.insert_supported(self.params)
 
-    def run_meta(self, cmd):
+        # the ImageBuilder may have been set up just now
+        fingerprint = fingerprint or self.upstream_fingerprint()
+        default_packages, profiles = info
+        if self.database.sync_subtarget(self.params, default_packages,
+                profiles, packages, fingerprint):
+            self.log.info("%s synced", subtarget)
+        else:
+            self.log.info("%s has no changes", subtarget)
+
+    def imagebuilder_dir(self):
+        return os.path.join(self.location, "imagebuilder",
+                self.params["distro"], self.params["version"],
+                self.params["target"], self.params["subtarget"])
+
+    # returns fingerprint of all package indexes the ImageBuilder uses and
+    # of the subtarget index containing the ImageBuilder itself
+    def upstream_fingerprint(self):
+        repositories_path = os.path.join(self.imagebuilder_dir(), "repositories.conf")
+        if not os.path.exists(repositories_path):
+            return None
+
+        urls = []
+        if "targets_url" in self.version_config:
+            urls.append("{}/{}/targets/{}/{}/sha256sums".format(
+                self.version_config["targets_url"].rstrip("/"),
+                self.version_config.get("parent_version", self.params["version"]),
+                self.params["target"], self.params["subtarget"]))
+        for kind, _, url in self.repositories():
+            if kind == "src/gz":
+                urls.append(url + "/Packages.gz")
+
+        if urls:
+            return get_fingerprint(urls)
+
+    # returns (type, name, url) of the repositories in repositories.conf
+    def repositories(self):
+        repositories = []
+        with open(os.path.join(self.imagebuilder_dir(), "repositories.conf")) as repositories_file:
+            for line in repositories_file:
+                repository = line.split()
+                if len(repository) == 3 and repository[0] in ["src", "src/gz"]:
+                    repositories.append(tuple(repository))
+        return repositories
+
+    # returns a MetaProcess yielding lines of stdout, if log_path is set the
+    # command and all output is appended to it
+    def run_meta(self, cmd, log_path=None):
         cmdline = ["sh", "meta", cmd ]
         env = os.environ.copy()
 
@@ -250,62 +603,50 @@ class Worker(threading.Thread):
         for key, value in self.params.items():
             env[key.upper()] = str(value) # TODO convert meta script to Makefile
 
-        proc = subprocess.Popen(
-            cmdline,
-            cwd=self.location,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            shell=False,
-            env=env
-        )
-
-        output, errors = proc.communicate()
-        return_code = proc.returncode
-        output = output.decode('utf-8')
-        errors = errors.decode('utf-8')
-
-        return (return_code, output, errors)
+        if log_path:
+            self.write_log(log_path, cmd)
 
+        return MetaProcess(cmdline, self.location, env, log_path)
 
+    # returns default packages and profiles
     def parse_info(self):
         self.log.debug("parse info")
 
-        return_code, output, errors = self.run_meta("info")
+        info = self.run_meta("info")
+        default_packages, profiles = parse_info(info)
 
-        if return_code == 0:
-            default_packages_pattern = r"(.*\n)*Default Packages: (.+)\n"
-            default_packages = re.match(default_packages_pattern, output, re.M).group(2)
+        if info.wait() == 0 and default_packages is not None:
             logging.debug("default packages: %s", default_packages)
-
-            profiles_pattern = r"(.+):\n    (.+)\n    Packages: (.*)\n"
-            profiles = re.findall(profiles_pattern, output)
-            if not profiles:
-                profiles = []
-            self.database.insert_profiles({
-                "distro": self.params["distro"],
-                "version": self.params["version"],
-                "target": self.params["target"],
-                "subtarget": self.params["subtarget"]},
-                default_packages, profiles)
+            return default_packages, profiles
         else:
             logging.error("could not receive profiles")
             return False
 
+    # returns (name, version) of all packages the ImageBuilder may install,
+    # read from the package indexes of its repositories instead of running
+    # opkg. the first repository listing a package wins, like for opkg
     def parse_packages(self):
         self.log.info("receive packages")
 
-        return_code, output, errors = self.run_meta("package_list")
+        packages = {}
+        for _, name, url in self.repositories():
+            try:
+                if url.startswith("file:"):
+                    index = parse_packages_folder(
+                            os.path.join(self.imagebuilder_dir(), url[len("file:"):]))
+                    for package, version, _ in index:
+                        packages.setdefault(package, version)
+                else:
+                    with urllib.request.urlopen(url + "/Packages.gz") as response:
+                        with gzip.open(response, "rt", encoding="utf-8", errors="replace") as index:
+                            for package, version, _ in parse_packages(index):
+                                packages.setdefault(package, version)
+            except (urllib.error.URLError, OSError, EOFError, tarfile.TarError, StopIteration) as e:
+                self.log.warning("could not receive packages of %s: %s", name, e)
+                return None
 
-        if return_code == 0:
-            packages = re.findall(r"(.+?) - (.+?) - .*\n", output)
-            self.log.info("found {} packages".format(len(packages)))
-            self.database.insert_packages_available({
-                "distro": self.params["distro"],
-                "version": self.params["version"],
-                "target": self.params["target"],
-                "subtarget": self.params["subtarget"]}, packages)
-        else:
-            self.log.warning("could not receive packages")
+        self.log.info("found {} packages".format(len(packages)))
+        return list(packages.items())
 
 class Updater(threading.Thread):
     def __init__(self):
@@ -313,7 +654,7 @@ class Updater(threading.Thread):
         self.log = logging.getLogger(__name__)
         self.config = Config()
         self.database = Database(self.config)
-        self.update_queue = Queue(1)
+        self.idle_workers = Queue()
 
     def run(self):
         location = self.config.get("updater_dir", "updater")
@@ -322,16 +663,30 @@ class Updater(threading.Thread):
 
         # start all workers
         for i in range(0, self.config.get("updater_threads", 4)):
-                worker = Worker(location, "update", self.update_queue)
+                worker = Worker(location, "update", Queue(1), self.idle_workers)
                 worker.start()
                 workers.append(worker)
 
+        interval = self.config.get("updater_interval", 86400)
+        hot_interval = self.config.get("updater_hot_interval", 3600)
+
         while True:
-            outdated_subtarget = self.database.get_subtarget_outdated()
-            if outdated_subtarget:
-                log.info("found outdated subtarget %s", outdated_subtarget)
-                self.update_queue.put(outdated_subtarget)
-            else:
+            # wait until a worker is idle, then collect all other idle ones
+            idle_workers = [self.idle_workers.get()]
+            while not self.idle_workers.empty():
+                idle_workers.append(self.idle_workers.get())
+
+            # most requested subtargets first
+            outdated_subtargets = self.database.get_subtargets_outdated(
+                    len(idle_workers), interval, hot_interval)
+            for outdated_subtarget in outdated_subtargets:
+                self.log.info("found outdated subtarget %s", outdated_subtarget)
+                idle_workers.pop().queue.put(outdated_subtarget)
+
+            for worker in idle_workers:
+                self.idle_workers.put(worker)
+
+            if not outdated_subtargets:
                 time.sleep(5)
 
 class Boss(threading.Thread):
@@ -340,24 +695,113 @@ class Boss(threading.Thread):
         self.log = logging.getLogger(__name__)
         self.config = Config()
         self.database = Database(self.config)
-        self.build_queue = Queue(1)
+        self.idle_workers = Queue()
+        # new requests send a notification, polling is only a fallback
+        self.listener = Listener(self.config, "image_requests")
+        self.job_slots = JobSlots(self.config.get("build_cores") or os.cpu_count(),
+                len(self.config.get("workers")))
+
+    # assign subtargets to idle workers, returns list of (worker, subtarget)
+    def schedule(self, idle_workers, build_queue):
+        max_wait = self.config.get("build_max_wait", 900)
+        pending = {}
+        starving = []
+        for distro, version, target, subtarget, requests, waiting in build_queue:
+            pending[(distro, version, target, subtarget)] = requests
+            if waiting > max_wait:
+                starving.append((waiting, (distro, version, target, subtarget)))
+
+        warm = { worker: worker.warm_subtargets() for worker in self.workers }
+        busy_warm = set()
+        for worker in self.workers:
+            if worker not in idle_workers:
+                busy_warm.update(warm[worker])
+
+        idle = list(idle_workers)
+        assignments = []
+
+        def assign(worker, subtarget):
+            idle.remove(worker)
+            del pending[subtarget]
+            assignments.append((worker, subtarget))
+
+        # cold starts go to workers not warm for any pending subtarget, a
+        # worker warm for another one only if no other is idle
+        def cold_worker():
+            for worker in idle:
+                if not any(subtarget in warm[worker] for subtarget in pending):
+                    return worker
+            return idle[0]
+
+        # requests waiting too long go first, even if that means a cold start
+        for _, subtarget in sorted(starving, reverse=True):
+            if not idle:
+                break
+            matches = [worker for worker in idle if subtarget in warm[worker]]
+            assign(matches[0] if matches else cold_worker(), subtarget)
+
+        # prefer workers which already have the ImageBuilder set up
+        for worker in list(idle):
+            matches = [subtarget for subtarget in pending if subtarget in warm[worker]]
+            if matches:
+                assign(worker, max(matches, key=pending.get))
+
+        # remaining workers set up a new ImageBuilder, preferable for
+        # subtargets no busy worker is warm for
+        for worker in list(idle):
+            if not pending:
+                break
+            assign(worker, max(pending, key=lambda subtarget:
+                (subtarget not in busy_warm, pending[subtarget])))
+
+        return assignments
 
     def run(self):
-        workers = []
+        self.workers = []
         for worker_location in self.config.get("workers"):
-            worker = Worker(worker_location, "image", self.build_queue)
+            worker = Worker(worker_location, "image", Queue(1), self.idle_workers, self.job_slots)
             worker.start()
-            workers.append(worker)
+            self.workers.append(worker)
+
+        self.log.info("Active workers are %s", self.workers)
 
-        self.log.info("Active workers are %s", workers)
+        poll_interval = self.config.get("boss_poll_interval", 10)
+        lease = self.config.get("build_lease_seconds", 300)
+        batch_size = self.config.get("build_batch_size", 4)
 
         while True:
-            build_job = self.database.get_build_job()
-            if build_job:
-                self.log.info("Found build job %s", build_job)
-                self.build_queue.put(build_job)
-            else:
-                time.sleep(10)
+            # requeued jobs notify all dispatchers
+            for request_hash in self.database.requeue_expired_leases():
+                self.log.warning("lease of %s expired, requeue", request_hash)
+
+            # wait until a worker is idle, then collect all other idle ones
+            try:
+                idle_workers = [self.idle_workers.get(timeout=poll_interval)]
+            except Empty:
+                continue
+            while not self.idle_workers.empty():
+                idle_workers.append(self.idle_workers.get())
+
+            dispatched = False
+            build_queue = self.database.get_build_queue()
+            for worker, subtarget in self.schedule(idle_workers, build_queue):
+                build_jobs = self.database.get_build_jobs(*subtarget,
+                        count=batch_size, lease=lease, worker=worker.location)
+                if not build_jobs:
+                    continue
+                if subtarget not in worker.warm_subtargets():
+                    self.log.info("cold start of %s on %s", subtarget, worker.location)
+                self.log.info("Found build jobs %s", [job["request_hash"] for job in build_jobs])
+                worker.subtargets.add(subtarget)
+                idle_workers.remove(worker)
+                worker.queue.put(build_jobs)
+                dispatched = True
+
+            for worker in idle_workers:
+                self.idle_workers.put(worker)
+
+            if not dispatched:
+                self.listener.wait(poll_interval)
 
 if __name__ == '__main__':
     logging.basicConfig(level=logging.DEBUG)